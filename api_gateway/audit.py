@@ -0,0 +1,255 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+import httpx
+
+# Асинхронная доставка аудит-логов в Logging Service.
+# Обработчики шлюза только кладут событие в ограниченную очередь и сразу отвечают клиенту,
+# а фоновая задача забирает события пачками и отправляет их в Logging Service.
+# Если Logging Service недоступен, события после всех попыток дописываются в файл на диске
+# и повторно отправляются, когда сервис снова отвечает. Файл пишется и читается в отдельном потоке
+# (asyncio.to_thread), чтобы дисковые операции не останавливали цикл событий и обработку запросов.
+
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", 10000))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 500))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", 0.5))
+AUDIT_MAX_RETRIES = int(os.getenv("AUDIT_MAX_RETRIES", 3))
+AUDIT_RETRY_BACKOFF = float(os.getenv("AUDIT_RETRY_BACKOFF", 0.2))
+AUDIT_REPLAY_INTERVAL = float(os.getenv("AUDIT_REPLAY_INTERVAL", 30))
+# Политика при переполнении очереди: 'spill' — писать на диск, 'drop' — отбросить новое событие,
+# 'drop_oldest' — вытеснить самое старое событие из очереди
+AUDIT_OVERFLOW_POLICY = os.getenv("AUDIT_OVERFLOW_POLICY", "spill")
+AUDIT_SPILL_PATH = os.getenv("AUDIT_SPILL_PATH", "audit_spill.ndjson")
+
+# Пакетный путь в Logging Service для каждого вида событий
+LOG_PATHS = {
+    "user": "/log/user/batch",
+    "call": "/log/call/batch",
+}
+
+
+class AuditLog:
+    """Ограниченная очередь аудит-событий с фоновой пакетной отправкой в Logging Service."""
+
+    def __init__(self, client_factory):
+        # client_factory возвращает пул соединений к Logging Service (см. upstream.py)
+        self.client_factory = client_factory
+        self.queue = None
+        self.task = None
+        # Пакеты событий, которые отправляются отдельным запросом мимо очереди (см. emit_batch)
+        self.direct = set()
+        # Пачка, которая собирается или отправляется прямо сейчас (досылается при остановке)
+        self.pending = []
+        # События, не поместившиеся в очередь при политике 'spill': обработчик запроса только добавляет их сюда,
+        # а на диск их пишет фоновая задача
+        self.overflow = []
+        self.overflow_task = None
+        # Запись и чтение файла сброса по очереди (записи из разных потоков и подмена файла при повторной отправке)
+        self.spill_lock = asyncio.Lock()
+        self.stats = {
+            "enqueued": 0,
+            "delivered": 0,
+            "rejected": 0,
+            "dropped": 0,
+            "spilled": 0,
+            "replayed": 0,
+            "retries": 0,
+            "failed_batches": 0,
+        }
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=AUDIT_QUEUE_SIZE)
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу, досылая всё, что осталось в очереди."""
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        if self.direct:
+            await asyncio.gather(*self.direct)
+        if self.overflow_task is not None:
+            await self.overflow_task
+        remaining = self.pending + self._drain(self.queue.qsize())
+        self.pending = []
+        if remaining:
+            await self._flush(remaining)
+
+    def emit(self, kind, data):
+        """
+        Кладёт событие в очередь, не дожидаясь отправки.
+        kind — 'user' или 'call', data — тело лога для Logging Service.
+        """
+        event = {"kind": kind, "data": data}
+        try:
+            self.queue.put_nowait(event)
+            self.stats["enqueued"] += 1
+            return
+        except asyncio.QueueFull:
+            pass
+
+        if AUDIT_OVERFLOW_POLICY == "drop":
+            self.stats["dropped"] += 1
+        elif AUDIT_OVERFLOW_POLICY == "drop_oldest":
+            self.queue.get_nowait()
+            self.queue.put_nowait(event)
+            self.stats["dropped"] += 1
+            self.stats["enqueued"] += 1
+        else:
+            self.overflow.append(event)
+            if self.overflow_task is None or self.overflow_task.done():
+                self.overflow_task = asyncio.create_task(self._write_overflow())
+
+    def emit_batch(self, kind, items):
+        """
+        Отправляет пачку событий одного вида (например, логи пакетной записи звонков) одним запросом
+        в Logging Service, не дожидаясь отправки и не занимая очередь.
+        Повторы и сброс на диск — как для событий из очереди.
+        """
+        events = [{"kind": kind, "data": data} for data in items]
+        if not events:
+            return
+        self.stats["enqueued"] += len(events)
+        task = asyncio.create_task(self._flush(events))
+        self.direct.add(task)
+        task.add_done_callback(self.direct.discard)
+
+    def snapshot(self):
+        """Текущее состояние очереди для мониторинга."""
+        return {
+            **self.stats,
+            "queued": self.queue.qsize() if self.queue else 0,
+            "queue_size": AUDIT_QUEUE_SIZE,
+            "overflow_policy": AUDIT_OVERFLOW_POLICY,
+            "spill_file_exists": os.path.exists(AUDIT_SPILL_PATH),
+        }
+
+    def _drain(self, limit):
+        events = []
+        while len(events) < limit and not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+    async def _next_batch(self):
+        """Ждёт первое событие, затем добирает пачку до AUDIT_BATCH_SIZE или до истечения AUDIT_FLUSH_INTERVAL."""
+        batch = self.pending = [await self.queue.get()]
+        deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL
+        while len(batch) < AUDIT_BATCH_SIZE:
+            batch.extend(self._drain(AUDIT_BATCH_SIZE - len(batch)))
+            timeout = deadline - time.monotonic()
+            if len(batch) >= AUDIT_BATCH_SIZE or timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        last_replay = 0.0
+        while True:
+            try:
+                batch = await asyncio.wait_for(self._next_batch(), AUDIT_REPLAY_INTERVAL)
+            except asyncio.TimeoutError:
+                batch = self.pending
+            delivered = await self._flush(batch) if batch else True
+            self.pending = []
+            if delivered and time.monotonic() - last_replay >= AUDIT_REPLAY_INTERVAL:
+                last_replay = time.monotonic()
+                await self._replay_spill()
+
+    async def _flush(self, events):
+        """
+        Отправляет пачку событий с повторами и экспоненциальной задержкой.
+        То, что не удалось доставить, сбрасывается на диск. Возвращает True, если доставлено всё.
+        """
+        by_kind = {}
+        for event in events:
+            by_kind.setdefault(event["kind"], []).append(event)
+
+        all_delivered = True
+        for kind, pending in by_kind.items():
+            for attempt in range(AUDIT_MAX_RETRIES + 1):
+                if attempt:
+                    self.stats["retries"] += 1
+                    delay = AUDIT_RETRY_BACKOFF * (2 ** (attempt - 1))
+                    await asyncio.sleep(delay + random.uniform(0, delay))
+                pending = await self._deliver(kind, pending)
+                if not pending:
+                    break
+            if pending:
+                all_delivered = False
+                self.stats["failed_batches"] += 1
+                await self._spill_async(pending)
+        return all_delivered
+
+    async def _deliver(self, kind, events):
+        """Отправляет события одного вида одним пакетным запросом, возвращает список недоставленных."""
+        try:
+            response = await self.client_factory().post(LOG_PATHS[kind], json=[event["data"] for event in events])
+        except httpx.HTTPError:
+            return events
+        if response.status_code >= 500:
+            return events
+        # Ошибки валидации (4xx и ошибки отдельных элементов) повторять бессмысленно
+        if response.status_code < 400:
+            try:
+                rejected = len(response.json().get("errors", []))
+            except (ValueError, AttributeError):
+                # Ответ 2xx без ожидаемого JSON: пакет принят, ошибок по элементам нет
+                rejected = 0
+        else:
+            rejected = len(events)
+        self.stats["rejected"] += rejected
+        self.stats["delivered"] += len(events) - rejected
+        return []
+
+    async def _write_overflow(self):
+        """Пишет на диск события, не поместившиеся в очередь, пока они появляются."""
+        while self.overflow:
+            events, self.overflow = self.overflow, []
+            await self._spill_async(events)
+
+    async def _spill_async(self, events):
+        async with self.spill_lock:
+            await asyncio.to_thread(self._spill, events)
+
+    def _spill(self, events):
+        with open(AUDIT_SPILL_PATH, "a", encoding="utf-8") as spill:
+            for event in events:
+                spill.write(json.dumps(event) + "\n")
+        self.stats["spilled"] += len(events)
+
+    @staticmethod
+    def _take_spill():
+        """Забирает файл сброса целиком и возвращает его события (пустой список, если файла нет)."""
+        if not os.path.exists(AUDIT_SPILL_PATH):
+            return []
+        replay_path = AUDIT_SPILL_PATH + ".replay"
+        os.replace(AUDIT_SPILL_PATH, replay_path)
+        with open(replay_path, encoding="utf-8") as spill:
+            events = [json.loads(line) for line in spill if line.strip()]
+        os.remove(replay_path)
+        return events
+
+    async def _replay_spill(self):
+        """Повторно отправляет события, сброшенные на диск, пока Logging Service был недоступен."""
+        async with self.spill_lock:
+            events = await asyncio.to_thread(self._take_spill)
+        for start in range(0, len(events), AUDIT_BATCH_SIZE):
+            chunk = events[start:start + AUDIT_BATCH_SIZE]
+            self.stats["replayed"] += len(chunk)
+            if not await self._flush(chunk):
+                # Остаток уже снова на диске, попробуем при следующем цикле
+                remaining = events[start + AUDIT_BATCH_SIZE:]
+                if remaining:
+                    await self._spill_async(remaining)
+                break
@@ -1,18 +1,52 @@
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+import asyncio
+import os
+from urllib.parse import quote
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-import httpx
-import os
+from starlette.background import BackgroundTask
 import dotenv
+import httpx
 
 dotenv.load_dotenv()
 
-app = FastAPI()
+from upstream import UpstreamUnavailable, upstreams
+import metrics
+from audit import AuditLog
+from usercache import UserCache
+from responsecache import RESPONSE_CACHE_MAX_BODY, CachedResponse, ResponseCache, etag_matches, group_ttl
+
+# Аудит-логи отправляются в Logging Service в фоне, пачками
+audit = AuditLog(lambda: upstreams("logging"))
+# Кэш пользователей: память шлюза -> callcache_service -> user_service
+user_cache = UserCache(lambda: upstreams("callcache"), lambda: upstreams("user"))
+# Кэш ответов читающих маршрутов с ETag (см. responsecache.py)
+response_cache = ResponseCache()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Создаём пулы соединений к сервисам при старте и закрываем их при остановке шлюза"""
+    await upstreams.start()
+    await audit.start()
+    try:
+        yield
+    finally:
+        await audit.stop()
+        await upstreams.close()
+
+
+app = FastAPI(lifespan=lifespan)
+# Время запросов по маршрутам, X-Request-ID и GET /metrics (см. metrics.py)
+metrics.init_app(app, upstreams)
+
 
-# Адреса сервисов
-USER_SERVICE_URL = os.getenv("USER_SERVICE_URL")
-CALL_SERVICE_URL = os.getenv("CALL_SERVICE_URL")
-LOGGING_SERVICE_URL = os.getenv("LOGGING_SERVICE_URL")
-CALLCACHE_SERVICE_URL = os.getenv("CALLCACHE_SERVICE_URL") 
+@app.exception_handler(UpstreamUnavailable)
+async def upstream_unavailable(request, error):
+    """Сервис временно недоступен (разомкнут выключатель или перегрузка) — клиенту 503 вместо ожидания таймаута"""
+    return JSONResponse({"detail": str(error)}, status_code=503, headers={"Retry-After": "1"})
 
 # Модель для данных пользователя
 class User(BaseModel):
@@ -22,151 +56,408 @@ class User(BaseModel):
 
 
 
+def cached_reply(request, entry):
+    """Ответ из кэша: 304 без тела, если у клиента уже есть эта версия (If-None-Match), иначе тело с ETag."""
+    headers = {"ETag": entry.etag, "Cache-Control": f"max-age={int(entry.ttl)}"}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        response_cache.stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type=entry.media_type, headers={**entry.headers, **headers})
+
+
+async def stream_upstream(name, path, params, request=None, cache_group=None):
+    """
+    Проксирует ответ сервиса клиенту по мере получения, не собирая его целиком в памяти шлюза.
+    Ошибки сервиса пробрасываются как HTTPException.
+    С cache_group ответ до RESPONSE_CACHE_MAX_BODY байт читается целиком, кэшируется и отдаётся с ETag;
+    более длинный ответ передаётся потоком без кэширования.
+    """
+    if cache_group:
+        key = response_cache.key(cache_group, request)
+        entry = response_cache.get(key)
+        if entry:
+            return cached_reply(request, entry)
+        generation = response_cache.generation(cache_group)
+
+    client = upstreams(name)
+    response = await client.send(client.build_request("GET", path, params=params), stream=True)
+    if response.status_code != 200:
+        detail = (await response.aread()).decode()
+        await response.aclose()
+        raise HTTPException(status_code=response.status_code, detail=detail)
+
+    # Тело передаётся как есть, поэтому вместе с ним передаём и его кодировку
+    headers = {
+        key: response.headers[key]
+        for key in ("X-Next-Cursor", "Content-Encoding")
+        if key in response.headers
+    }
+    media_type = response.headers.get("content-type", "application/json")
+    body = response.aiter_raw()
+
+    if cache_group:
+        chunks, size = [], 0
+        async for chunk in body:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > RESPONSE_CACHE_MAX_BODY:
+                break
+        else:
+            await response.aclose()
+            entry = CachedResponse(b"".join(chunks), media_type, headers, group_ttl(cache_group))
+            response_cache.put(key, entry, generation)
+            return cached_reply(request, entry)
+
+        response_cache.stats["too_large"] += 1
+        rest = body
+
+        async def body():
+            for chunk in chunks:
+                yield chunk
+            async for chunk in rest:
+                yield chunk
+        body = body()
+
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers=headers,
+        background=BackgroundTask(response.aclose),
+    )
+
+
 @app.get("/")
 async def user_service_home():
     """Главная страница User Service через API Gateway"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{USER_SERVICE_URL}/")
-        if response.status_code == 200:
-            return response.text  # Возвращаем текстовое содержимое
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+    response = await upstreams("user").get("/")
+    if response.status_code == 200:
+        return response.text  # Возвращаем текстовое содержимое
+    else:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
 
 
 @app.post("/users/")
 async def create_user(user: User):
-    """Создать нового пользователя через User Service и записать лог через Logging Service"""
-    async with httpx.AsyncClient() as client:
-        # Шаг 1: Создать пользователя через User Service
-        response = await client.post(f"{USER_SERVICE_URL}/users/", json=user.model_dump())
-        
-        if response.status_code == 201:
-            user_response = response.json()
-
-            # Шаг 2: Создать лог для пользователя через Logging Service
-            log_data = {
-                "username": user_response.get('name', user.name),  # Используем имя из ответа или переданного объекта
-                "action": "User created"
-            }
-            
-            log_response = await client.post(f"{LOGGING_SERVICE_URL}/log/user", json=log_data)
-            
-            if log_response.status_code == 201:
-                return {"message": "User created and logged successfully", "user": user_response}
-            else:
-                raise HTTPException(status_code=log_response.status_code, detail="Failed to log the user creation")
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+    """Создать нового пользователя через User Service и поставить лог в очередь для Logging Service"""
+    # Шаг 1: Создать пользователя через User Service
+    response = await upstreams("user").post("/users/", json=user.model_dump())
+
+    if response.status_code == 201:
+        user_response = response.json()
+
+        # Шаг 2: Создать лог для пользователя через Logging Service
+        log_data = {
+            "username": user_response.get('name', user.name),  # Используем имя из ответа или переданного объекта
+            "action": "User created"
+        }
+
+        # Лог отправляется в фоне и не задерживает ответ клиенту
+        audit.emit("user", log_data)
+        await user_cache.put(user_response)
+        response_cache.invalidate("users", "logs")
+        return {"message": "User created and logged successfully", "user": user_response}
+    else:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+
+
+@app.post("/users/bulk")
+async def create_users_bulk(request: Request):
+    """
+    Создать пачку пользователей (JSON-массив или NDJSON) через User Service одним запросом
+    и поставить логи всех созданных пользователей одной пачкой для Logging Service.
+    Тело передаётся в User Service как есть, без разбора в шлюзе.
+    """
+    headers = {"Content-Type": request.headers.get("content-type", "application/json")}
+    response = await upstreams("user").post("/users/bulk", content=await request.body(), headers=headers)
+
+    if response.status_code == 201:
+        result = response.json()
+        created = [item["user"] for item in result["users"]]
+        audit.emit_batch("user", [{"username": user["name"], "action": "User created"} for user in created])
+        user_cache.forget(created)
+        response_cache.invalidate("users", "logs")
+        return JSONResponse(result, status_code=201)
+    else:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+
 
-        
 @app.get("/users/")
-async def users():
-    """Получить информацию о пользователях через User Service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{USER_SERVICE_URL}/users/")
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+async def users(request: Request):
+    """
+    Получить информацию о пользователях через User Service (с кэшем ответов и ETag).
+    Параметры запроса (username, phone, ids, phones, limit, cursor) передаются как есть.
+    """
+    params = list(request.query_params.multi_items())
+    return await stream_upstream("user", "/users/", params, request, "users")
+
+async def load_user(params=None, user_id=None):
+    """Достаёт пользователя из User Service по ID или по фильтру (username/phone); None, если его нет."""
+    if user_id is not None:
+        response = await upstreams("user").get(f"/users/{user_id}")
+    else:
+        response = await upstreams("user").get("/users/", params=params)
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+    if user_id is not None:
+        return response.json()
+    found = response.json()
+    return found[0] if found else None
+
+
+@app.get("/users/lookup")
+async def lookup_user(username: str | None = None, phone: str | None = None):
+    """Найти пользователя по имени или телефону (через кэш, при промахе — через User Service)"""
+    if username:
+        key, params = ("username", username), {"username": username}
+    elif phone:
+        key, params = ("phone", phone), {"phone": phone}
+    else:
+        raise HTTPException(status_code=400, detail="Username or phone is required!")
+    user = await user_cache.get(key, lambda: load_user(params=params))
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+
+@app.get("/users/by-phone/{number}")
+async def get_user_by_phone(request: Request, number: str):
+    """Найти пользователя по номеру телефона в любой записи (User Service приводит его к E.164)"""
+    return await stream_upstream("user", f"/users/by-phone/{quote(number, safe='')}", None, request, "users")
+
+
+@app.get("/users/search")
+async def search_users(request: Request, prefix: str, limit: int | None = None):
+    """Найти пользователей по началу номера телефона через User Service"""
+    params = {'prefix': prefix}
+    if limit is not None:
+        params['limit'] = limit
+    return await stream_upstream("user", "/users/search", params, request, "users")
+
 
 @app.get("/users/{user_id}")
 async def get_user(user_id: int):
-    """Получить информацию о пользователе по ID через User Service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{USER_SERVICE_URL}/users/{user_id}")
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+    """Получить информацию о пользователе по ID (через кэш, при промахе — через User Service)"""
+    user = await user_cache.get(("id", str(user_id)), lambda: load_user(user_id=user_id))
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
 
 @app.delete("/users/{user_id}")
 async def remove_user(user_id: int):
     """Удалить пользователя через User Service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.delete(f"{USER_SERVICE_URL}/users/{user_id}")
-        if response.status_code == 200:
-            return {"message": "User deleted successfully."}
-        elif response.status_code == 404:
-            raise HTTPException(status_code=404, detail="User not found!")
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+    response = await upstreams("user").delete(f"/users/{user_id}")
+    if response.status_code in (200, 404):
+        await user_cache.invalidate(user_id)
+        response_cache.invalidate("users", "logs")
+    if response.status_code == 200:
+        return {"message": "User deleted successfully."}
+    elif response.status_code == 404:
+        raise HTTPException(status_code=404, detail="User not found!")
+    else:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
 
 @app.post("/calls/")
 async def make_call(request: Request):
-    """Инициировать звонок через Call Service и создать лог через Logging Service"""
+    """Инициировать звонок через Call Service и поставить лог в очередь для Logging Service"""
     call_data = await request.json()
 
     # Шаг 1: Отправка запроса в Call Service
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{CALL_SERVICE_URL}/call/", json=call_data)
-        
-        if response.status_code == 201:
-            # Шаг 2: Создание лога звонка через Logging Service
-            call_response = response.json()
-            log_data = {
-                "username": call_response['username'],
-                "call_duration": 0,  # Задайте подходящее значение
-                "status": call_response['status']
-            }
-
-            log_response = await client.post(f"{LOGGING_SERVICE_URL}/log/call", json=log_data)
-            
-            if log_response.status_code == 201:
-                return {"message": "Call created and logged successfully", "call": call_response}
-            else:
-                raise HTTPException(status_code=log_response.status_code, detail="Failed to log the call")
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+    response = await upstreams("call").post("/call/", json=call_data)
+
+    if response.status_code == 201:
+        # Шаг 2: Создание лога звонка через Logging Service
+        call_response = response.json()
+        log_data = {
+            "username": call_response['username'],
+            "call_duration": 0,  # Задайте подходящее значение
+            "status": call_response['status']
+        }
+
+        # Лог отправляется в фоне и не задерживает ответ клиенту
+        audit.emit("call", log_data)
+        response_cache.invalidate("calls", "logs")
+        return {"message": "Call created and logged successfully", "call": call_response}
+    else:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+
+@app.post("/calls/batch")
+async def make_calls_batch(request: Request):
+    """
+    Записать пачку звонков (JSON-массив или NDJSON) через Call Service одним запросом
+    и поставить логи всех записанных звонков одной пачкой для Logging Service.
+    Тело передаётся в Call Service как есть, без разбора в шлюзе.
+    """
+    headers = {"Content-Type": request.headers.get("content-type", "application/json")}
+    response = await upstreams("call").post("/call/batch", content=await request.body(), headers=headers)
+
+    if response.status_code == 201:
+        result = response.json()
+        audit.emit_batch("call", [
+            {"username": item["call"]["username"], "call_duration": 0, "status": item["call"]["status"]}
+            for item in result["calls"]
+        ])
+        response_cache.invalidate("calls", "logs")
+        return JSONResponse(result, status_code=201)
+    else:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
 
 @app.get("/calls/history/")
-async def get_call_history():
-    """Получить историю звонков через Call Service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{CALL_SERVICE_URL}/call/history/")
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+async def get_call_history(request: Request):
+    """
+    Получить историю звонков через Call Service (потоково, без буферизации в шлюзе; небольшие ответы кэшируются).
+    Параметры username, since, until, status, limit, cursor и format передаются в Call Service как есть.
+    """
+    params = {
+        key: value for key, value in request.query_params.items()
+        if key in ("username", "since", "until", "status", "limit", "cursor", "format")
+    }
+    return await stream_upstream("call", "/call/history/", params, request, "calls")
 
 
 @app.get("/calls/history/last/")
 async def get_last_call():
     """Получить последний звонок через Call Service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{CALL_SERVICE_URL}/call/history/last/")
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+    response = await upstreams("call").get("/call/history/last/")
+    if response.status_code == 200:
+        return response.json()
+    else:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+
+@app.get("/calls/history/last/{username:path}")
+async def get_user_last_call(username: str):
+    """Получить последний звонок пользователя через Call Service"""
+    # Имя экранируется целиком: '/', '?' и '#' в имени не должны менять маршрут в Call Service
+    response = await upstreams("call").get(f"/call/history/last/{quote(username, safe='')}")
+    if response.status_code == 200:
+        return response.json()
+    else:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+
+def log_query_params(start_date, end_date, limit, cursor, format):
+    """Параметры запроса логов: период, страница (limit/cursor) и формат выдачи (json/ndjson)"""
+    params = {'start_date': start_date, 'end_date': end_date}
+    if limit is not None:
+        params['limit'] = limit
+    if cursor:
+        params['cursor'] = cursor
+    if format:
+        params['format'] = format
+    return params
+
 
 @app.get("/logs/calls/")
-async def get_call_logs(start_date: str, end_date: str):
-    """Получить логи звонков за период времени через Logging Service"""
-    # Формируем параметры запроса
+async def get_call_logs(request: Request, start_date: str, end_date: str, limit: int | None = None, cursor: str | None = None, format: str | None = None):
+    """Получить логи звонков за период времени через Logging Service (потоково, без буферизации в шлюзе)"""
+    params = log_query_params(start_date, end_date, limit, cursor, format)
+    return await stream_upstream("logging", "/log/calls/", params, request, "logs")
+
+
+@app.get("/logs/calls/stats")
+async def get_call_stats(request: Request, start_date: str, end_date: str, interval: str | None = None, username: str | None = None, group_by: str | None = None, limit: int | None = None):
+    """Получить статистику звонков за период (по интервалам и пользователям) через Logging Service"""
     params = {'start_date': start_date, 'end_date': end_date}
-    
-    # Отправляем запрос в Logging Service
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{LOGGING_SERVICE_URL}/log/calls/", params=params)
-        
-        if response.status_code == 200:
-            return response.json()  # Возвращаем логи звонков
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+    optional = {'interval': interval, 'username': username, 'group_by': group_by, 'limit': limit}
+    params.update({key: value for key, value in optional.items() if value is not None})
+    return await stream_upstream("logging", "/log/calls/stats", params, request, "logs")
+
 
 @app.get("/logs/users/")
-async def get_user_logs(start_date: str, end_date: str):
-    """Получить логи звонков за период времени через Logging Service"""
-    # Формируем параметры запроса
-    params = {'start_date': start_date, 'end_date': end_date}
-    
-    # Отправляем запрос в Logging Service
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{LOGGING_SERVICE_URL}/log/users/", params=params)
-        
-        if response.status_code == 200:
-            return response.json()  # Возвращаем логи звонков
-        else:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
-        
+async def get_user_logs(request: Request, start_date: str, end_date: str, limit: int | None = None, cursor: str | None = None, format: str | None = None):
+    """Получить логи пользователей за период времени через Logging Service (потоково, без буферизации в шлюзе)"""
+    params = log_query_params(start_date, end_date, limit, cursor, format)
+    return await stream_upstream("logging", "/log/users/", params, request, "logs")
+
+
+# Сводка по абоненту: сколько секунд ждать каждую часть (OVERVIEW_TIMEOUT_<ЧАСТЬ>, иначе OVERVIEW_TIMEOUT),
+# за какой период (в секундах до текущего момента) и сколько логов звонков показывать
+OVERVIEW_TIMEOUT = float(os.getenv("OVERVIEW_TIMEOUT", 2))
+OVERVIEW_LOGS_PERIOD = int(os.getenv("OVERVIEW_LOGS_PERIOD", 3600))
+OVERVIEW_LOGS_LIMIT = int(os.getenv("OVERVIEW_LOGS_LIMIT", 20))
+
+
+async def overview_part(name, coroutine):
+    """Ждёт часть сводки не дольше её таймаута. Возвращает (данные, ошибка); ошибка не прерывает остальные части."""
+    timeout = float(os.getenv(f"OVERVIEW_TIMEOUT_{name.upper()}", OVERVIEW_TIMEOUT))
+    try:
+        return await asyncio.wait_for(coroutine, timeout), None
+    except asyncio.TimeoutError:
+        return None, "Timed out"
+    except HTTPException as error:
+        return None, f"{error.status_code}: {error.detail}"
+    except httpx.HTTPError as error:
+        return None, f"{type(error).__name__}: {error}"
+
+
+async def fetch_json(name, path, params=None):
+    """GET к сервису; None при 404."""
+    response = await upstreams(name).get(path, params=params)
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+    return response.json()
+
+
+@app.get("/subscribers/{user_id}/overview")
+async def subscriber_overview(user_id: int, start_date: str | None = None, end_date: str | None = None):
+    """
+    Сводка для страницы абонента за один запрос: пользователь (через кэш), последний звонок и логи звонков.
+    Сервисы опрашиваются параллельно, поэтому время ответа — максимум, а не сумма их задержек.
+    Если какой-то сервис не ответил вовремя или вернул ошибку, его часть равна null,
+    причина указана в 'errors', а остальные части возвращаются как обычно.
+    """
+    if not start_date or not end_date:
+        now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        start_date = (now - timedelta(seconds=OVERVIEW_LOGS_PERIOD)).isoformat()
+        end_date = now.isoformat()
+    log_params = {"start_date": start_date, "end_date": end_date, "limit": OVERVIEW_LOGS_LIMIT}
+
+    parts = {
+        "user": user_cache.get(("id", str(user_id)), lambda: load_user(user_id=user_id)),
+        "last_call": fetch_json("call", "/call/history/last/"),
+        "call_logs": fetch_json("logging", "/log/calls/", log_params),
+    }
+    results = await asyncio.gather(*(overview_part(name, coroutine) for name, coroutine in parts.items()))
+
+    overview, errors = {}, {}
+    for name, (data, error) in zip(parts, results):
+        overview[name] = data
+        if error:
+            errors[name] = error
+    if overview["user"] is None and "user" not in errors:
+        raise HTTPException(status_code=404, detail="User not found")
+    if overview["call_logs"] is None and "call_logs" not in errors:
+        overview["call_logs"] = []
+    return {**overview, "errors": errors, "partial": bool(errors)}
+
+
+@app.get("/admin/upstreams")
+async def upstream_stats():
+    """Статистика пулов соединений к сервисам (для подбора лимитов пула)"""
+    return upstreams.stats()
+
+
+@app.get("/admin/resilience")
+async def resilience_stats():
+    """Состояние защитного слоя по сервисам: выключатель, бюджет повторов, дублирующие запросы, отказы при перегрузке"""
+    return upstreams.resilience_stats()
+
+
+@app.get("/admin/audit")
+async def audit_stats():
+    """Состояние очереди аудит-логов: доставлено, в очереди, сброшено на диск, отброшено"""
+    return audit.snapshot()
+
+
+@app.get("/admin/response-cache")
+async def response_cache_stats():
+    """Счётчики кэша ответов: попадания, промахи, ответы 304, сбросы"""
+    return response_cache.snapshot()
+
 
+@app.get("/admin/user-cache")
+async def user_cache_stats():
+    """Счётчики кэша пользователей: попадания (в памяти, в Redis, негативные), промахи, объединённые запросы"""
+    return user_cache.snapshot()
@@ -0,0 +1,84 @@
+import time
+import uuid
+from contextvars import ContextVar
+
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+# Метрики шлюза в формате Prometheus (GET /metrics) и идентификатор запроса.
+# Каждый запрос получает X-Request-ID (из заголовка клиента или nginx, иначе новый), который передаётся
+# во все запросы к сервисам и возвращается клиенту: по нему сопоставляются строки журналов всех звеньев.
+# Время запросов к сервисам измеряется для каждой попытки отдельно (повторы и дублирующие запросы тоже).
+
+REQUEST_ID_HEADER = "X-Request-ID"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Идентификатор текущего запроса; задачи, созданные во время запроса, наследуют его
+request_id = ContextVar("request_id", default=None)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Время обработки запроса шлюзом до начала ответа",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds",
+    "Время запроса шлюза к сервису до получения заголовков ответа",
+    ["upstream", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+class UpstreamCollector:
+    """Состояние пулов соединений и выключателей на момент опроса."""
+
+    def __init__(self, upstreams):
+        self.upstreams = upstreams
+
+    def collect(self):
+        connections = GaugeMetricFamily(
+            "upstream_connections", "Соединения пула к сервису", labels=["upstream", "state"]
+        )
+        in_flight = GaugeMetricFamily("upstream_in_flight", "Запросы к сервису в процессе", labels=["upstream"])
+        breaker_open = GaugeMetricFamily(
+            "upstream_breaker_open", "Выключатель сервиса разомкнут или пропускает пробные запросы", labels=["upstream"]
+        )
+        for name, stats in self.upstreams.stats().items():
+            connections.add_metric([name, "active"], stats["active"])
+            connections.add_metric([name, "idle"], stats["idle"])
+            in_flight.add_metric([name], stats["in_flight"])
+        for name, stats in self.upstreams.resilience_stats().items():
+            breaker_open.add_metric([name], 0 if stats["breaker"]["state"] == "closed" else 1)
+        return [connections, in_flight, breaker_open]
+
+
+def observe_upstream(upstream, method, status, started):
+    UPSTREAM_LATENCY.labels(upstream, method, status).observe(time.perf_counter() - started)
+
+
+def init_app(app, upstreams):
+    """Измерение времени запросов по маршрутам, X-Request-ID и маршрут GET /metrics."""
+    REGISTRY.register(UpstreamCollector(upstreams))
+
+    @app.middleware("http")
+    async def observe_request(request, call_next):
+        current = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        token = request_id.set(current)
+        started = time.perf_counter()
+        status = "500"
+        try:
+            response = await call_next(request)
+            status = str(response.status_code)
+        finally:
+            # Шаблон маршрута, а не путь: /users/{user_id}, чтобы число рядов метрики не росло с числом ID
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            REQUEST_LATENCY.labels(request.method, route, status).observe(time.perf_counter() - started)
+            request_id.reset(token)
+        response.headers[REQUEST_ID_HEADER] = current
+        return response
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+# Кэш ответов шлюза для читающих маршрутов (GET /users/, /calls/history/, /logs/*).
+# Ответ сервиса хранится целиком (тело и заголовки) по пути и параметрам запроса несколько секунд,
+# к нему вычисляется строгий ETag по содержимому, поэтому повторный запрос с If-None-Match получает 304
+# без тела. Маршруты, изменяющие данные, сбрасывают свою группу ответов ('users', 'calls', 'logs').
+
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 2))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1000))
+# Ответы больше этого размера не кэшируются, а передаются потоком как раньше
+RESPONSE_CACHE_MAX_BODY = int(os.getenv("RESPONSE_CACHE_MAX_BODY", 1024 * 1024))
+
+
+def group_ttl(group):
+    """TTL группы: RESPONSE_CACHE_TTL_<GROUP>, иначе общий RESPONSE_CACHE_TTL."""
+    return float(os.getenv(f"RESPONSE_CACHE_TTL_{group.upper()}", RESPONSE_CACHE_TTL))
+
+
+def make_etag(body):
+    """Строгий ETag по содержимому тела ответа."""
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag):
+    """Совпадает ли ETag с заголовком If-None-Match (слабое сравнение, как требует RFC 9110 для If-None-Match)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+
+class CachedResponse:
+    def __init__(self, body, media_type, headers, ttl):
+        self.body = body
+        self.media_type = media_type
+        self.headers = headers
+        self.etag = make_etag(body)
+        self.ttl = ttl
+        self.expires = time.monotonic() + ttl
+
+
+class ResponseCache:
+    """LRU-кэш ответов с TTL по группам и поколениями для безопасного сброса."""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        # Поколение группы растёт при каждом сбросе: ответ, запрошенный до сброса, не попадёт в кэш после него
+        self.generations = {}
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "stored": 0,
+            "too_large": 0,
+            "not_modified": 0,
+            "invalidations": 0,
+        }
+
+    @staticmethod
+    def key(group, request):
+        return group, request.url.path, tuple(sorted(request.query_params.multi_items()))
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry.expires < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def generation(self, group):
+        return self.generations.get(group, 0)
+
+    def put(self, key, entry, generation):
+        group = key[0]
+        if generation != self.generation(group):
+            return
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.stats["stored"] += 1
+        while len(self.entries) > RESPONSE_CACHE_SIZE:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *groups):
+        """Сбрасывает ответы групп (после изменения данных)."""
+        for group in groups:
+            self.generations[group] = self.generation(group) + 1
+            self.stats["invalidations"] += 1
+        for key in [key for key in self.entries if key[0] in groups]:
+            del self.entries[key]
+
+    def snapshot(self):
+        return {**self.stats, "entries": len(self.entries), "max_entries": RESPONSE_CACHE_SIZE}
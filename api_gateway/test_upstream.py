@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+import httpx
+
+from upstream import CircuitBreaker, ResilientTransport, UpstreamUnavailable
+
+# Проверки выключателя ResilientTransport. Запуск: cd api_gateway && python -m pytest test_upstream.py
+
+
+class HangingTransport(httpx.AsyncBaseTransport):
+    """Транспорт, который не отвечает, пока запрос не отменят."""
+
+    async def handle_async_request(self, request):
+        await asyncio.Event().wait()
+
+
+class OkTransport(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request):
+        return httpx.Response(200, request=request)
+
+
+def half_open_transport(transport):
+    resilient = ResilientTransport("test", transport, 0)
+    resilient.breaker = CircuitBreaker(failures=1, reset_timeout=0.05, half_open_probes=1)
+    resilient.breaker.record(False)
+    time.sleep(0.06)
+    return resilient
+
+
+def test_cancelled_probe_releases_slot():
+    async def scenario():
+        resilient = half_open_transport(HangingTransport())
+        request = httpx.Request("POST", "http://test/call/")
+        probe = asyncio.ensure_future(resilient.handle_async_request(request))
+        await asyncio.sleep(0.01)
+        assert resilient.breaker.state == "half_open" and resilient.breaker.probes == 1
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+        assert resilient.breaker.probes == 0
+
+        resilient.transport = OkTransport()
+        response = await resilient.handle_async_request(request)
+        assert response.status_code == 200
+        assert resilient.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_probe_by_wait_for_timeout():
+    async def scenario():
+        resilient = half_open_transport(HangingTransport())
+        request = httpx.Request("GET", "http://test/call/history/")
+        try:
+            await asyncio.wait_for(resilient.handle_async_request(request), timeout=0.01)
+        except asyncio.TimeoutError:
+            pass
+        assert resilient.breaker.probes == 0
+        resilient.transport = OkTransport()
+        assert (await resilient.handle_async_request(request)).status_code == 200
+
+    asyncio.run(scenario())
+
+
+def test_half_open_without_outcome_reopens():
+    breaker = CircuitBreaker(failures=1, reset_timeout=0.05, half_open_probes=1)
+    breaker.record(False)
+    time.sleep(0.06)
+    assert breaker.allow()
+    # Проба так и не сообщила результат: новые запросы отклоняются, пока не истечёт reset_timeout
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert not breaker.allow()
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.state == "half_open"
+
+
+def test_rejected_while_probe_in_flight():
+    async def scenario():
+        resilient = half_open_transport(HangingTransport())
+        request = httpx.Request("GET", "http://test/")
+        probe = asyncio.ensure_future(resilient.handle_async_request(request))
+        await asyncio.sleep(0.01)
+        try:
+            await resilient.handle_async_request(request)
+        except UpstreamUnavailable:
+            pass
+        else:
+            raise AssertionError("second request must be rejected while the probe is in flight")
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+
+    asyncio.run(scenario())
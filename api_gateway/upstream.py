@@ -0,0 +1,375 @@
+import asyncio
+import os
+import random
+import time
+
+import dotenv
+import httpx
+
+from metrics import REQUEST_ID_HEADER, observe_upstream, request_id
+
+dotenv.load_dotenv()
+
+# Общий слой HTTP-клиентов шлюза к внутренним сервисам.
+# Клиенты создаются один раз при старте приложения (lifespan) и закрываются при остановке,
+# поэтому соединения к сервисам переиспользуются (keep-alive), а не открываются на каждый запрос.
+# Поверх пула каждый запрос проходит через ResilientTransport: ограничение числа одновременных запросов,
+# автоматический выключатель (circuit breaker), повторы GET в пределах бюджета и дублирующие (hedged) запросы.
+
+# Адреса сервисов
+UPSTREAM_URLS = {
+    "user": os.getenv("USER_SERVICE_URL"),
+    "call": os.getenv("CALL_SERVICE_URL"),
+    "logging": os.getenv("LOGGING_SERVICE_URL"),
+    "callcache": os.getenv("CALLCACHE_SERVICE_URL"),
+}
+
+
+def _setting(name, key, default, cast=str):
+    """
+    Возвращает настройку пула для сервиса.
+    Сначала ищется UPSTREAM_<NAME>_<KEY>, затем общий UPSTREAM_<KEY>, иначе значение по умолчанию.
+    """
+    value = os.getenv(f"UPSTREAM_{name.upper()}_{key}", os.getenv(f"UPSTREAM_{key}"))
+    if value is None or value == "":
+        return default
+    if cast is bool:
+        return value.lower() in ("1", "true", "yes")
+    return cast(value)
+
+
+def _http2_available():
+    """HTTP/2 включается только если установлен пакет h2."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class MeteredTransport(httpx.AsyncHTTPTransport):
+    """
+    Транспорт httpx, который считает запросы к сервису,
+    чтобы по статистике можно было подобрать размер пула.
+    Каждая попытка попадает в гистограмму upstream_request_duration_seconds и несёт X-Request-ID запроса шлюза.
+    """
+
+    def __init__(self, max_connections, name="", **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        self.max_connections = max_connections
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+        self.wait_time_total = 0.0
+
+    async def handle_async_request(self, request):
+        self.in_flight += 1
+        self.requests_total += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        current = request_id.get()
+        if current:
+            request.headers.setdefault(REQUEST_ID_HEADER, current)
+        started = time.perf_counter()
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            self.errors_total += 1
+            observe_upstream(self.name, request.method, "error", started)
+            raise
+        finally:
+            self.in_flight -= 1
+            self.wait_time_total += time.perf_counter() - started
+        observe_upstream(self.name, request.method, str(response.status_code), started)
+        return response
+
+    def stats(self):
+        """Текущее состояние пула соединений."""
+        connections = list(self._pool.connections)
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return {
+            "max_connections": self.max_connections,
+            "connections": len(connections),
+            "idle": idle,
+            "active": len(connections) - idle,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "avg_request_time": (self.wait_time_total / self.requests_total) if self.requests_total else 0.0,
+        }
+
+
+class UpstreamUnavailable(httpx.TransportError):
+    """Запрос к сервису не отправлялся: выключатель разомкнут или сервис перегружен. Шлюз отвечает 503."""
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель: после BREAKER_FAILURES ошибок подряд запросы к сервису не отправляются
+    BREAKER_RESET_TIMEOUT секунд, затем пропускается BREAKER_HALF_OPEN_PROBES пробных запросов.
+    Успешная проба замыкает выключатель, ошибка — снова размыкает. Проба, отменённая без ответа,
+    освобождает своё место (release); если за BREAKER_RESET_TIMEOUT ни одна проба не дала ответа,
+    выключатель снова размыкается.
+    """
+
+    def __init__(self, failures, reset_timeout, half_open_probes):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.half_opened_at = 0.0
+        self.probes = 0
+        self.opened_total = 0
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self.half_opened_at = time.monotonic()
+            self.probes = 0
+        if self.state == "half_open":
+            if self.probes >= self.half_open_probes:
+                if time.monotonic() - self.half_opened_at >= self.reset_timeout:
+                    # Пробы зависли без ответа: выключатель не должен оставаться полуоткрытым навсегда
+                    self._open()
+                return False
+            self.probes += 1
+        return True
+
+    def release(self):
+        """Возвращает место пробы, которая завершилась без ответа (запрос отменён)."""
+        if self.state == "half_open" and self.probes > 0:
+            self.probes -= 1
+
+    def record(self, success):
+        if self.state == "open":
+            # Ответы на запросы, отправленные до размыкания, состояние не меняют
+            return
+        if success:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            return
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failures:
+            self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.opened_total += 1
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "opened_total": self.opened_total,
+        }
+
+
+class RetryBudget:
+    """
+    Бюджет повторов: каждый запрос добавляет ratio жетона, каждый повтор тратит один жетон.
+    Так повторы не превышают заданной доли от потока запросов и не умножают нагрузку на упавший сервис.
+    """
+
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    """Защитный слой над транспортом сервиса (см. описание модуля)."""
+
+    IDEMPOTENT_METHODS = ("GET", "HEAD")
+    # Ответы, после которых идемпотентный запрос имеет смысл повторить
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, name, transport, max_in_flight):
+        self.name = name
+        self.transport = transport
+        self.max_in_flight = max_in_flight
+        self.breaker = CircuitBreaker(
+            _setting(name, "BREAKER_FAILURES", 5, int),
+            _setting(name, "BREAKER_RESET_TIMEOUT", 10.0, float),
+            _setting(name, "BREAKER_HALF_OPEN_PROBES", 1, int),
+        )
+        self.budget = RetryBudget(
+            _setting(name, "RETRY_BUDGET_RATIO", 0.2, float),
+            _setting(name, "RETRY_BUDGET_MAX", 10.0, float),
+        )
+        self.retries = _setting(name, "RETRIES", 2, int)
+        self.retry_backoff = _setting(name, "RETRY_BACKOFF", 0.05, float)
+        # Через сколько секунд без ответа отправлять дублирующий GET (0 — не отправлять)
+        self.hedge_after = _setting(name, "HEDGE_AFTER", 0.0, float)
+        self.in_flight = 0
+        self.counters = {
+            "shed": 0,
+            "rejected_open": 0,
+            "retries": 0,
+            "retries_denied": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+        }
+
+    async def handle_async_request(self, request):
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            self.counters["shed"] += 1
+            raise UpstreamUnavailable(f"Service {self.name} is overloaded", request=request)
+        if not self.breaker.allow():
+            self.counters["rejected_open"] += 1
+            raise UpstreamUnavailable(f"Service {self.name} is unavailable (circuit open)", request=request)
+
+        # Попытка заняла место пробы полуоткрытого выключателя и ещё не сообщила ему результат
+        probe = self.breaker.state == "half_open"
+        idempotent = request.method in self.IDEMPOTENT_METHODS
+        if idempotent:
+            self.budget.deposit()
+        self.in_flight += 1
+        try:
+            attempt = 0
+            while True:
+                try:
+                    response = await self._send(request, idempotent)
+                except httpx.TransportError:
+                    probe = False
+                    self.breaker.record(False)
+                    if not self._may_retry(idempotent, attempt):
+                        raise
+                else:
+                    probe = False
+                    self.breaker.record(response.status_code < 500)
+                    if response.status_code not in self.RETRY_STATUSES or not self._may_retry(idempotent, attempt):
+                        return response
+                    await response.aclose()
+                probe = self.breaker.state == "half_open"
+                attempt += 1
+                delay = self.retry_backoff * (2 ** (attempt - 1))
+                await asyncio.sleep(delay + random.uniform(0, delay))
+        finally:
+            self.in_flight -= 1
+            if probe:
+                # Запрос отменён (клиент отключился, истёк wait_for, проиграна гонка дублей) до ответа сервиса
+                self.breaker.release()
+
+    def _may_retry(self, idempotent, attempt):
+        if not idempotent or attempt >= self.retries:
+            return False
+        if not self.budget.withdraw():
+            self.counters["retries_denied"] += 1
+            return False
+        if not self.breaker.allow():
+            return False
+        self.counters["retries"] += 1
+        return True
+
+    async def _send(self, request, idempotent):
+        """Отправляет запрос; для GET при включённом HEDGE_AFTER — с дублирующим запросом против «хвоста» задержек."""
+        if not (idempotent and self.hedge_after):
+            return await self.transport.handle_async_request(request)
+
+        first = asyncio.ensure_future(self.transport.handle_async_request(request))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                self.counters["hedged"] += 1
+                tasks.add(asyncio.ensure_future(self.transport.handle_async_request(request)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.counters["hedge_wins"] += 1
+                        for other in done - {task}:
+                            if other.exception() is None:
+                                await other.result().aclose()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "breaker": self.breaker.stats(),
+            "retry_budget_tokens": round(self.budget.tokens, 2),
+            "hedge_after": self.hedge_after,
+            **self.counters,
+        }
+
+
+class Upstreams:
+    """Набор долгоживущих клиентов httpx — по одному на каждый внутренний сервис."""
+
+    def __init__(self, urls=None):
+        self.urls = dict(urls or UPSTREAM_URLS)
+        self.clients = {}
+        self.transports = {}
+        self.resilience = {}
+
+    def _build_client(self, name, base_url):
+        max_connections = _setting(name, "MAX_CONNECTIONS", 100, int)
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=_setting(name, "MAX_KEEPALIVE", 20, int),
+            keepalive_expiry=_setting(name, "KEEPALIVE_EXPIRY", 30.0, float),
+        )
+        timeout = httpx.Timeout(
+            connect=_setting(name, "CONNECT_TIMEOUT", 2.0, float),
+            read=_setting(name, "READ_TIMEOUT", 10.0, float),
+            write=_setting(name, "WRITE_TIMEOUT", 10.0, float),
+            pool=_setting(name, "POOL_TIMEOUT", 5.0, float),
+        )
+        http2 = _setting(name, "HTTP2", True, bool) and _http2_available()
+        transport = MeteredTransport(max_connections, name=name, limits=limits, http2=http2)
+        self.transports[name] = transport
+        # Сверх MAX_IN_FLIGHT одновременных запросов новые сразу получают отказ, а не ждут в очереди пула
+        resilient = ResilientTransport(name, transport, _setting(name, "MAX_IN_FLIGHT", max_connections * 2, int))
+        self.resilience[name] = resilient
+        return httpx.AsyncClient(base_url=base_url or "", transport=resilient, timeout=timeout)
+
+    async def start(self):
+        for name, url in self.urls.items():
+            self.clients[name] = self._build_client(name, url)
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+        self.transports.clear()
+        self.resilience.clear()
+
+    def __call__(self, name):
+        """Возвращает клиента для сервиса по его имени ('user', 'call', 'logging', 'callcache')."""
+        return self.clients[name]
+
+    def stats(self):
+        return {name: transport.stats() for name, transport in self.transports.items()}
+
+    def resilience_stats(self):
+        return {name: transport.stats() for name, transport in self.resilience.items()}
+
+
+upstreams = Upstreams()
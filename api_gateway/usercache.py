@@ -0,0 +1,166 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+import httpx
+
+# Кэш пользователей в шлюзе.
+# Чтение идёт по цепочке: память процесса -> callcache_service (Redis) -> user_service.
+# Найденный в user_service пользователь записывается в оба уровня кэша, а отсутствие пользователя (404)
+# кэшируется коротко, только в памяти процесса. Одновременные промахи по одному ключу объединяются
+# в один запрос к user_service (single-flight), чтобы популярный ключ не обрушил базу после истечения TTL.
+
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 300))
+USER_CACHE_LOCAL_TTL = float(os.getenv("USER_CACHE_LOCAL_TTL", 5))
+USER_CACHE_NEGATIVE_TTL = float(os.getenv("USER_CACHE_NEGATIVE_TTL", 5))
+USER_CACHE_LOCAL_SIZE = int(os.getenv("USER_CACHE_LOCAL_SIZE", 10000))
+
+# Отметка об отсутствии пользователя в кэше
+NOT_FOUND = object()
+
+
+def cache_params(key):
+    """Ключ кэша ('id', '5') превращается в параметры запроса к callcache_service."""
+    field, value = key
+    return {field: value}
+
+
+def user_cache_keys(user):
+    """Все ключи, под которыми пользователь user_service ({'id', 'name', 'phone'}) лежит в кэше."""
+    return [("id", str(user["id"])), ("username", user["name"]), ("phone", user["phone"])]
+
+
+class UserCache:
+    """Read-through/write-through кэш пользователей с TTL, негативным кэшированием и single-flight."""
+
+    def __init__(self, cache_client, user_client):
+        # Фабрики клиентов callcache_service и user_service (см. upstream.py)
+        self.cache_client = cache_client
+        self.user_client = user_client
+        self.local = OrderedDict()
+        self.in_flight = {}
+        self.stats = {
+            "local_hits": 0,
+            "remote_hits": 0,
+            "negative_hits": 0,
+            "misses": 0,
+            "loads": 0,
+            "coalesced": 0,
+            "cache_errors": 0,
+        }
+
+    def snapshot(self):
+        return {**self.stats, "local_size": len(self.local), "in_flight": len(self.in_flight)}
+
+    def _local_get(self, key):
+        entry = self.local.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.local[key]
+            return None
+        self.local.move_to_end(key)
+        return value
+
+    def _local_set(self, key, value, ttl):
+        self.local[key] = (time.monotonic() + ttl, value)
+        self.local.move_to_end(key)
+        while len(self.local) > USER_CACHE_LOCAL_SIZE:
+            self.local.popitem(last=False)
+
+    async def get(self, key, load):
+        """
+        Возвращает пользователя по ключу ('id' | 'username' | 'phone', значение) или None, если его нет.
+        load — корутина, которая достаёт пользователя из user_service и возвращает его или None.
+        """
+        value = self._local_get(key)
+        if value is NOT_FOUND:
+            self.stats["negative_hits"] += 1
+            return None
+        if value is not None:
+            self.stats["local_hits"] += 1
+            return value
+
+        # Одновременные запросы за одним ключом ждут первый
+        if key in self.in_flight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        # Загрузка идёт отдельной задачей: если запрос, начавший её, отменят (например, по таймауту),
+        # остальные ожидающие всё равно получат результат
+        task = asyncio.ensure_future(self._fetch(key, load))
+        self.in_flight[key] = task
+        task.add_done_callback(lambda done: self._load_done(key, done))
+        return await asyncio.shield(task)
+
+    def _load_done(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        if not task.cancelled():
+            # Исключение передано ожидающим; если их не осталось, помечаем его как полученное
+            task.exception()
+
+    async def _fetch(self, key, load):
+        user = await self._remote_get(key)
+        if user is not None:
+            self.stats["remote_hits"] += 1
+            self._local_set(key, user, USER_CACHE_LOCAL_TTL)
+            return user
+
+        self.stats["misses"] += 1
+        self.stats["loads"] += 1
+        user = await load()
+        if user is None:
+            self._local_set(key, NOT_FOUND, USER_CACHE_NEGATIVE_TTL)
+            return None
+        await self.put(user)
+        return user
+
+    async def _remote_get(self, key):
+        try:
+            response = await self.cache_client().get("/cache/user", params=cache_params(key))
+        except httpx.HTTPError:
+            # Недоступный кэш не должен ломать чтение, идём в user_service
+            self.stats["cache_errors"] += 1
+            return None
+        if response.status_code != 200:
+            return None
+        data = response.json()
+        if data.get("id") is None:
+            # Запись положена не шлюзом (без ID) — формат user_service восстановить нельзя
+            return None
+        return {"id": data["id"], "name": data["username"], "phone": data["phone"]}
+
+    async def put(self, user):
+        """Записывает пользователя в оба уровня кэша (write-through после создания или загрузки)."""
+        for key in user_cache_keys(user):
+            self._local_set(key, user, USER_CACHE_LOCAL_TTL)
+        payload = {"id": user["id"], "username": user["name"], "phone": user["phone"], "ttl": USER_CACHE_TTL}
+        try:
+            await self.cache_client().post("/cache/user", json=payload)
+        except httpx.HTTPError:
+            self.stats["cache_errors"] += 1
+
+    def forget(self, users):
+        """
+        Удаляет из памяти процесса записи о созданных пачкой пользователях, в том числе отметки об их отсутствии.
+        В кэш они не записываются, чтобы большая пачка не вытеснила горячие записи: их загрузит первое чтение.
+        """
+        for user in users:
+            for key in user_cache_keys(user):
+                self.local.pop(key, None)
+
+    async def invalidate(self, user_id):
+        """Удаляет пользователя из обоих уровней кэша по ID (при удалении пользователя)."""
+        user = self._local_get(("id", str(user_id)))
+        keys = [("id", str(user_id))]
+        if isinstance(user, dict):
+            keys = user_cache_keys(user)
+        for key in keys:
+            self.local.pop(key, None)
+        try:
+            await self.cache_client().delete("/cache/user", params={"id": str(user_id)})
+        except httpx.HTTPError:
+            self.stats["cache_errors"] += 1
@@ -0,0 +1,200 @@
+from contextlib import asynccontextmanager
+import json
+import os
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.http import http_date
+
+import metrics
+from models import Base, Call
+from queries import (
+    CALL_BATCH_MAX_ITEMS, CALL_STREAM_CHUNK, QueryError, batch_insert, batch_result, encode_cursor, history_query,
+    last_call_query, last_call_upsert, latest_call, naive_utc, parse_batch, parse_call, user_last_call_query,
+    validate_batch,
+)
+
+# Асинхронная версия call_service (SERVER_MODE=async, запуск через uvicorn).
+# Тот же JSON-контракт, что и у Flask-приложения в main.py, но запросы к базе идут через asyncpg,
+# поэтому один процесс держит сотни одновременных записей звонков, не занимая поток на каждый commit.
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def async_database_url(url):
+    """URL базы из SQLALCHEMY_DATABASE_URI с асинхронным драйвером (psycopg2 -> asyncpg)."""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+engine = create_async_engine(
+    async_database_url(os.getenv("SQLALCHEMY_DATABASE_URI")),
+    pool_size=int(os.getenv("DB_POOL_SIZE", 20)),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 80)),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    pool_pre_ping=True,
+)
+AsyncSession = async_sessionmaker(engine, expire_on_commit=False)
+
+DB_CREATE_ON_STARTUP = os.getenv("DB_CREATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Создаём таблицы один раз при старте и закрываем пул соединений при остановке"""
+    if DB_CREATE_ON_STARTUP:
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+    yield
+    await engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
+# Время запросов по маршрутам и к базе, X-Request-ID и GET /metrics (см. metrics.py)
+metrics.init_asgi(app)
+metrics.instrument_engine(engine.sync_engine)
+
+
+def serialize_call(call):
+    return {"id": call.id, "username": call.username, "date": naive_utc(call.date), "status": call.status}
+
+
+def to_json(call):
+    # Дата в том же формате, что отдаёт Flask (RFC 822, GMT)
+    return {**call, "date": http_date(call["date"])}
+
+
+def dumps(data):
+    return json.dumps(data, sort_keys=True)
+
+
+@app.get("/", response_class=PlainTextResponse)
+async def home():
+    return "Welcome by call_service!"
+
+
+@app.post("/call/")
+async def call(request: Request):
+    """Создает запись о новом звонке в базе данных (см. main.call)."""
+    try:
+        data = await request.json()
+    except ValueError:  # Тело не разобрать как JSON (в том числе не UTF-8) — как get_json(silent=True) во Flask
+        data = None
+    try:
+        new_call = Call(**parse_call(data))
+    except QueryError as error:
+        return JSONResponse({"message": str(error)}, status_code=400)
+
+    async with AsyncSession() as session:
+        session.add(new_call)
+        await session.flush()  # Получаем id и дату по умолчанию
+        # Последний звонок пользователя обновляется в той же транзакции
+        await session.execute(last_call_upsert(engine.dialect.name, [new_call]))
+        await session.commit()  # Сохраняем запись в базе данных
+    result = serialize_call(new_call)
+    latest_call.offer(result)
+    return JSONResponse(to_json(result), status_code=201)
+
+
+@app.post("/call/batch")
+async def call_batch(request: Request):
+    """Записывает пачку звонков одним многострочным INSERT в одной транзакции (см. main.call_batch)."""
+    mimetype = request.headers.get("content-type", "").split(";")[0].strip()
+    items = parse_batch((await request.body()).decode(), mimetype)
+    if items is None:
+        return JSONResponse({"message": "Expected a JSON array or NDJSON body!"}, status_code=400)
+    if len(items) > CALL_BATCH_MAX_ITEMS:
+        return JSONResponse({"message": f"Batch is too large! Maximum is {CALL_BATCH_MAX_ITEMS} items."}, status_code=413)
+
+    rows, errors = validate_batch(items)
+    calls = []
+    if rows:
+        async with AsyncSession() as session:
+            calls = (await session.scalars(batch_insert(), [row for _, row in rows])).all()
+            # Последние звонки пользователей обновляются одним запросом в той же транзакции
+            await session.execute(last_call_upsert(engine.dialect.name, calls))
+            await session.commit()
+
+    result = batch_result(rows, calls, errors, serialize_call)
+    if calls:
+        latest_call.offer(max((item["call"] for item in result["calls"]), key=lambda call: (call["date"], call["id"])))
+    result["calls"] = [{**item, "call": to_json(item["call"])} for item in result["calls"]]
+    return JSONResponse(result, status_code=201 if rows or not items else 400)
+
+
+@app.get("/call/history/")
+async def history(request: Request):
+    """Возвращает историю звонков, упорядоченную по (date, id), потоково (см. main.history)."""
+    try:
+        query, limit = history_query(request.query_params)
+    except QueryError as error:
+        return JSONResponse({"message": str(error)}, status_code=400)
+
+    headers = {}
+    session = AsyncSession()
+    if limit is not None:
+        # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+        page = (await session.scalars(query.limit(limit + 1))).all()
+        await session.close()
+        if len(page) > limit:
+            page = page[:limit]
+            headers["X-Next-Cursor"] = encode_cursor(page[-1])
+
+        async def rows():
+            for call in page:
+                yield call
+    else:
+        async def rows():
+            try:
+                result = await session.stream_scalars(query.execution_options(yield_per=CALL_STREAM_CHUNK))
+                async for call in result:
+                    yield call
+            finally:
+                await session.close()
+
+    ndjson = request.query_params.get('format') == 'ndjson'
+
+    async def generate():
+        first = True
+        if not ndjson:
+            yield "["
+        async for call in rows():
+            if not first:
+                yield "\n" if ndjson else ","
+            first = False
+            yield dumps(to_json(serialize_call(call)))
+        if ndjson:
+            yield "" if first else "\n"
+        else:
+            yield "]"
+
+    media_type = "application/x-ndjson" if ndjson else "application/json"
+    return StreamingResponse(generate(), media_type=media_type, headers=headers)
+
+
+@app.get("/call/history/last/")
+async def get_call_last_some():
+    """Возвращает данные о последнем звонке (из памяти процесса или из базы) или 404, если звонков нет."""
+    cached = latest_call.get()
+    if cached:
+        return JSONResponse(to_json(cached))
+    async with AsyncSession() as session:
+        last_call = (await session.scalars(last_call_query())).first()
+    if last_call:
+        result = serialize_call(last_call)
+        latest_call.set(result)
+        return JSONResponse(to_json(result))
+    return JSONResponse({"message": "No calls found."}, status_code=404)
+
+
+@app.get("/call/history/last/{username:path}")
+async def get_user_last_call(username: str):
+    """Возвращает последний звонок пользователя по первичному ключу таблицы last_calls или 404."""
+    async with AsyncSession() as session:
+        last_call = (await session.scalars(user_last_call_query(username))).first()
+    if last_call:
+        return JSONResponse(to_json(serialize_call(last_call)))
+    return JSONResponse({"message": "No calls found."}, status_code=404)
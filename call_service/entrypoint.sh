@@ -0,0 +1,19 @@
+#!/bin/sh
+# Схема приводится к актуальной до запуска сервиса: flask migrate снимает устаревшее ограничение
+# уникальности calls.username и заполняет last_calls по истории (DB_MIGRATE_ON_STARTUP=false — миграции запускаются отдельно)
+if [ "${DB_MIGRATE_ON_STARTUP:-true}" = "true" ]; then
+    flask --app main migrate || exit 1
+fi
+# Режим запуска задаётся SERVER_MODE:
+# production (по умолчанию) — gunicorn с несколькими воркерами, development — встроенный сервер Flask,
+# async — асинхронная версия сервиса на asyncpg (async_main.py) под uvicorn
+# Воркеры gunicorn и uvicorn пишут метрики Prometheus в общий каталог, GET /metrics отдаёт их сумму (см. metrics.py)
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+if [ "${SERVER_MODE:-production}" = "async" ]; then
+    exec uvicorn async_main:app --host 0.0.0.0 --port 8002 --workers "${UVICORN_WORKERS:-1}" --timeout-keep-alive "${UVICORN_KEEPALIVE:-30}"
+fi
+if [ "${SERVER_MODE:-production}" = "development" ]; then
+    exec flask run --host=0.0.0.0 --port=8002
+fi
+exec gunicorn --config gunicorn.conf.py main:app
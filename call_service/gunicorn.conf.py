@@ -0,0 +1,64 @@
+import math
+import multiprocessing
+import os
+
+# Настройки gunicorn для режима production (см. entrypoint.sh)
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8002')}"
+
+
+def cpu_limit():
+    """
+    Число CPU, доступных контейнеру: квота cgroup (docker --cpus), иначе ядра, на которых разрешено работать процессу.
+    multiprocessing.cpu_count() возвращает число ядер хоста и не учитывает ограничения контейнера.
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:  # cgroup v2
+            quota, period = cpu_max.read().split()[:2]
+    except (OSError, ValueError):
+        try:  # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as quota_file, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as period_file:
+                quota, period = quota_file.read().strip(), period_file.read().strip()
+        except OSError:
+            quota, period = "max", "1"
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else multiprocessing.cpu_count()
+    if quota not in ("max", "-1"):
+        cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    return cpus
+
+
+# У каждого воркера свой пул соединений с базой (DB_POOL_SIZE по умолчанию равен GUNICORN_THREADS, см. models.py),
+# поэтому число воркеров ограничено: иначе на многоядерном хосте сервисы исчерпают max_connections Postgres.
+# Процессы-воркеры: по умолчанию 2 * CPU + 1 по квоте контейнера, но не больше GUNICORN_MAX_WORKERS (4)
+workers = int(os.getenv("GUNICORN_WORKERS", min(cpu_limit() * 2 + 1, int(os.getenv("GUNICORN_MAX_WORKERS", 4)))))
+# Потоки в каждом воркере (gthread): пока один поток ждёт базу или Redis, другие обслуживают запросы
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+worker_class = "gthread" if threads > 1 else "sync"
+# Загрузка приложения в мастер-процессе до fork экономит память и ускоряет старт воркеров
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ("1", "true", "yes")
+# Keep-alive соединений от api_gateway
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 30))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+# Плавный перезапуск (kill -HUP): столько секунд воркеры дообслуживают текущие запросы
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+# Периодический перезапуск воркеров защищает от утечек памяти
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 1000))
+accesslog = os.getenv("GUNICORN_ACCESSLOG", "-")
+# В журнале — время ответа в миллисекундах и X-Request-ID, по которому запрос находится в журналах других сервисов
+access_log_format = os.getenv(
+    "GUNICORN_ACCESS_LOG_FORMAT", '%(h)s %(t)s "%(r)s" %(s)s %(b)s %(M)sms request_id=%({x-request-id}o)s'
+)
+
+
+def post_fork(server, worker):
+    # При preload движок SQLAlchemy создан в мастер-процессе ещё до fork.
+    # Воркер не должен пользоваться унаследованными сокетами: сбрасываем пул, не закрывая соединения мастера
+    from models import engine
+    engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    # Метрики-gauge завершившегося воркера больше не учитываются (см. metrics.py)
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
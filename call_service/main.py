@@ -1,26 +1,46 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 import os
 import dotenv
 
 app = Flask(__name__)
 
 # Импортируем модели, чтобы они регистрировались в SQLAlchemy
-from models import Call,start_db,session
-# Создаем таблицы, если их нет
-@app.before_request
-def create_tables():
-    """
-    Перед каждым запросом проверяем наличие таблиц в базе данных.
-    Если таблиц нет, они будут автоматически созданы.
-    """
+from models import Call,Session,engine,start_db,session,migrate
+from queries import (
+    CALL_BATCH_MAX_ITEMS, CALL_STREAM_CHUNK, QueryError, batch_insert, batch_result, encode_cursor, history_query,
+    last_call_query, last_call_upsert, latest_call, naive_utc, parse_batch, parse_call, user_last_call_query,
+    validate_batch,
+)
+import metrics
+
+# Время запросов по маршрутам и к базе, X-Request-ID и GET /metrics (см. metrics.py)
+metrics.init_app(app)
+metrics.instrument_engine(engine)
+
+# Схема создаётся один раз при старте сервиса, а не перед каждым запросом.
+# При DB_CREATE_ON_STARTUP=false схемой управляет только команда `flask migrate`.
+DB_CREATE_ON_STARTUP = os.getenv("DB_CREATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+if DB_CREATE_ON_STARTUP:
     start_db()
 
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Закрываем сессию запроса и возвращаем соединение в пул."""
+    session.remove()
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Создаёт таблицы и недостающие индексы."""
+    migrate()
+    print("Migration completed.")
+
+
 @app.get("/")
 def home():
     return "Welcome by call_service!"
 
-from datetime import datetime
-
 @app.post("/call/")
 def call():
     """
@@ -34,54 +54,148 @@ def call():
     Возвращает:
     - ID звонка, имя пользователя, дату и статус.
     """
-    data = request.json
-    if not data or 'username' not in data or 'status' not in data:
-        return jsonify({"message": "Username and status are required!"}), 400
+    try:
+        # Тело, которое не разобрать как JSON, — та же ошибка 400, что и в асинхронной версии
+        new_call = Call(**parse_call(request.get_json(silent=True)))
+    except QueryError as error:
+        return jsonify({"message": str(error)}), 400
 
-    # Приведение статуса к булевому типу
-    status = data['status'].lower() in ['true', 'completed', 'yes']
+    session.add(new_call)
+    session.flush()  # Получаем id и дату по умолчанию
+    # Последний звонок пользователя обновляется в той же транзакции
+    session.execute(last_call_upsert(engine.dialect.name, [new_call]))
+    session.commit()  # Сохраняем запись в базе данных
+    result = serialize_call(new_call)
+    latest_call.offer(result)
+    return jsonify(result), 201
 
-    # Используем текущую дату и время, если 'date' отсутствует
-    date = data.get('date')
-    if date:
+
+@app.post("/call/batch")
+def call_batch():
+    """
+    Записывает пачку звонков (например, выгрузку CDR) одним многострочным INSERT в одной транзакции.
+
+    Ожидает JSON-массив или NDJSON (Content-Type: application/x-ndjson), каждый элемент — как для /call/.
+    Некорректные элементы не записываются. Возвращает:
+    - 'inserted': количество записанных звонков
+    - 'calls': записанные звонки с индексами исходных элементов
+    - 'errors': ошибки по индексам элементов
+    """
+    items = parse_batch(request.get_data(as_text=True), request.mimetype)
+    if items is None:
+        return jsonify({"message": "Expected a JSON array or NDJSON body!"}), 400
+    if len(items) > CALL_BATCH_MAX_ITEMS:
+        return jsonify({"message": f"Batch is too large! Maximum is {CALL_BATCH_MAX_ITEMS} items."}), 413
+
+    rows, errors = validate_batch(items)
+    calls = []
+    if rows:
         try:
-            date = datetime.fromisoformat(date)
-        except ValueError:
-            return jsonify({"message": "Invalid date format. Use ISO 8601."}), 400
-    else:
-        date = None  # SQLAlchemy подставит значение по умолчанию
+            calls = session.scalars(batch_insert(), [row for _, row in rows]).all()
+            # Последние звонки пользователей обновляются одним запросом в той же транзакции
+            session.execute(last_call_upsert(engine.dialect.name, calls))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
 
-    new_call = Call(username=data['username'], date=date, status=status)
-    session.add(new_call)
-    session.commit()  # Сохраняем запись в базе данных
-    return jsonify({"id": new_call.id, "username": new_call.username, "date": new_call.date, "status": new_call.status}), 201
+    result = batch_result(rows, calls, errors, serialize_call)
+    if calls:
+        latest_call.offer(max((item["call"] for item in result["calls"]), key=lambda call: (call["date"], call["id"])))
+    return jsonify(result), 201 if rows or not items else 400
 
 
+def serialize_call(call):
+    return {"id": call.id, "username": call.username, "date": naive_utc(call.date), "status": call.status}
 
 
 @app.get("/call/history/")
 def history():
     """
-    Возвращает всю историю звонков из базы данных.
+    Возвращает историю звонков из базы данных, упорядоченную по (date, id).
     Каждая запись включает:
     - ID звонка
     - Имя пользователя
     - Дата звонка
     - Статус звонка
+
+    Необязательные параметры (см. queries.history_query):
+    - 'username', 'since', 'until', 'status': фильтры
+    - 'limit', 'cursor': страница; курсор следующей страницы возвращается в заголовке X-Next-Cursor
+    - 'format': 'ndjson' — по одной записи в строке вместо JSON-массива
+
+    Записи читаются серверным курсором и сразу отправляются клиенту, поэтому память не зависит от объёма истории.
     """
-    all_calls = session.query(Call).all()  # Получаем всю историю звонков
-    return jsonify([{"id": call.id, "username": call.username, "date": call.date, "status": call.status} for call in all_calls])
+    try:
+        query, limit = history_query(request.args)
+    except QueryError as error:
+        return jsonify({"message": str(error)}), 400
+
+    headers = {}
+    # Отдельная сессия живёт, пока ответ не будет отправлен целиком:
+    # сессия запроса закрывается раньше, чем начинается потоковая отправка
+    stream_session = Session()
+    if limit is not None:
+        # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+        page = stream_session.scalars(query.limit(limit + 1)).all()
+        if len(page) > limit:
+            page = page[:limit]
+            headers["X-Next-Cursor"] = encode_cursor(page[-1])
+        calls = page
+    else:
+        calls = stream_session.scalars(query.execution_options(yield_per=CALL_STREAM_CHUNK))
+
+    ndjson = request.args.get('format') == 'ndjson'
+
+    def generate():
+        try:
+            first = True
+            if not ndjson:
+                yield "["
+            for call in calls:
+                if not first:
+                    yield "\n" if ndjson else ","
+                first = False
+                yield app.json.dumps(serialize_call(call))
+            if ndjson:
+                yield "" if first else "\n"
+            else:
+                yield "]"
+        finally:
+            stream_session.close()
+
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(generate(), mimetype=mimetype, headers=headers)
 
 @app.get("/call/history/last/")
 def get_call_last_some():
     """
     Возвращает данные о последнем звонке.
+    Звонок берётся из памяти процесса (см. queries.LatestCallCache), а при устаревании — из базы по индексу.
 
     Если записей в базе данных нет, возвращает сообщение с ошибкой.
     """
-    last_call = session.query(Call).order_by(Call.date.desc()).first()  # Получаем последний звонок
+    cached = latest_call.get()
+    if cached:
+        return jsonify(cached)
+    last_call = session.scalars(last_call_query()).first()  # Получаем последний звонок
+    if last_call:
+        result = serialize_call(last_call)
+        latest_call.set(result)
+        return jsonify(result)
+    return jsonify({"message": "No calls found."}), 404
+
+
+@app.get("/call/history/last/<path:username>")
+def get_user_last_call(username):
+    """
+    Возвращает последний звонок пользователя по первичному ключу таблицы last_calls.
+
+    Если у пользователя нет звонков, возвращает сообщение с ошибкой.
+    """
+    last_call = session.scalars(user_last_call_query(username)).first()
     if last_call:
-        return jsonify({"id": last_call.id, "username": last_call.username, "date": last_call.date, "status": last_call.status})
+        return jsonify(serialize_call(last_call))
     return jsonify({"message": "No calls found."}), 404
 
 
@@ -1,7 +1,9 @@
    
-from sqlalchemy import create_engine, Column, Integer, String,DateTime,Boolean
+from sqlalchemy import create_engine, Column, Integer, String,DateTime,Boolean,Index,func,select,text,tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker, synonym
 from datetime import datetime,timezone
 import dotenv
 dotenv.load_dotenv()
@@ -9,27 +11,91 @@ import os
 
 url_db=os.getenv("SQLALCHEMY_DATABASE_URI")
 print(url_db)
-engine = create_engine(url_db)
+# Пул соединений: размер, переполнение, проверка соединения перед выдачей и пересоздание старых соединений
+engine = create_engine(
+    url_db,
+    # Поток воркера держит одно соединение, поэтому пул по умолчанию равен числу потоков gunicorn
+    pool_size=int(os.getenv("DB_POOL_SIZE", os.getenv("GUNICORN_THREADS", 4))),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 2)),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    pool_pre_ping=True,
+)
 
 # Создаем базовый класс для моделей
 Base = declarative_base()
 
-# Настраиваем сессию для взаимодействия с базой данных
+# Настраиваем сессию для взаимодействия с базой данных.
+# scoped_session выдаёт каждому потоку (запросу) свою сессию; в конце запроса её закрывает session.remove()
 Session = sessionmaker(bind=engine)
-session = Session()
+session = scoped_session(Session)
 
 
 # Пример модели  
 class Call(Base):  
     __tablename__ = 'calls' 
     id = Column(Integer, primary_key=True)  
-    username = Column(String(80), unique=True, nullable=False)  
-    date = Column(DateTime,default=lambda: datetime.now(timezone.utc))
+    # У одного пользователя может быть сколько угодно звонков
+    username = Column(String(80), nullable=False)  
+    # Время в UTC без пояса, как и в остальных колонках DateTime
+    date = Column(DateTime,default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
     status = Column(Boolean,nullable=False)
-    
+
+    # Индексы под keyset-пагинацию истории по (date, id), в том числе с фильтром по пользователю
+    __table_args__ = (
+        Index('ix_calls_date_id', 'date', 'id'),
+        Index('ix_calls_username_date_id', 'username', 'date', 'id'),
+    )
+
     def __repr__(self):
         return f'<Call(username={self.username}, date={self.data} , status = {self.status})>'
 
 
+# Последний звонок каждого пользователя. Обновляется в той же транзакции, что и запись звонка,
+# поэтому последний звонок пользователя читается по первичному ключу, без поиска по истории
+class LastCall(Base):
+    __tablename__ = 'last_calls'
+    username = Column(String(80), primary_key=True)
+    call_id = Column(Integer, nullable=False)
+    date = Column(DateTime, nullable=False)
+    status = Column(Boolean, nullable=False)
+
+    id = synonym("call_id")  # Чтобы serialize_call одинаково сериализовал Call и LastCall
+
+
 def start_db():
-    Base.metadata.create_all(engine)
\ No newline at end of file
+    Base.metadata.create_all(engine)
+
+
+def migrate():
+    """
+    Создаёт таблицы и индексы, которых ещё нет (в том числе для таблиц, созданных до появления индексов),
+    снимает устаревшее ограничение уникальности calls.username и заполняет last_calls по истории звонков.
+    """
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+        for index in Call.__table__.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("ALTER TABLE calls DROP CONSTRAINT IF EXISTS calls_username_key"))
+
+        # Последний звонок каждого пользователя по истории. Запись заменяется, только если она старше
+        # найденного звонка, поэтому миграцию можно повторять и после того, как сервис уже принимал звонки
+        ranked = select(
+            Call.username, Call.id, Call.date, Call.status,
+            func.row_number().over(partition_by=Call.username, order_by=(Call.date.desc(), Call.id.desc())).label("rank"),
+        ).where(Call.date.is_not(None)).subquery()
+        insert = postgresql.insert if connection.dialect.name == "postgresql" else sqlite.insert
+        statement = insert(LastCall).from_select(
+            ["username", "call_id", "date", "status"],
+            select(ranked.c.username, ranked.c.id, ranked.c.date, ranked.c.status).where(ranked.c.rank == 1),
+        )
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[LastCall.username],
+            set_={
+                "call_id": statement.excluded.call_id,
+                "date": statement.excluded.date,
+                "status": statement.excluded.status,
+            },
+            where=tuple_(LastCall.date, LastCall.call_id) < tuple_(statement.excluded.date, statement.excluded.call_id),
+        ))
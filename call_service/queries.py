@@ -0,0 +1,265 @@
+from datetime import datetime, timezone
+import base64
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import insert, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import Call, LastCall
+
+# Разбор запросов call_service, общий для синхронного (Flask) и асинхронного (asyncpg) приложений
+
+# Размер порции строк, которую серверный курсор базы данных отдаёт за раз
+CALL_STREAM_CHUNK = int(os.getenv("CALL_STREAM_CHUNK", 1000))
+# Максимальный размер страницы истории
+CALL_PAGE_MAX_LIMIT = int(os.getenv("CALL_PAGE_MAX_LIMIT", 10000))
+# Сколько секунд процесс отдаёт последний звонок из памяти, не обращаясь к базе
+CALL_LAST_CACHE_TTL = float(os.getenv("CALL_LAST_CACHE_TTL", 1.0))
+# Максимальное число звонков в одном пакетном запросе
+CALL_BATCH_MAX_ITEMS = int(os.getenv("CALL_BATCH_MAX_ITEMS", 10000))
+
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonlines")
+
+
+class QueryError(ValueError):
+    """Некорректные данные запроса; сообщение возвращается клиенту с кодом 400."""
+
+
+def parse_status(status):
+    """Приведение статуса к булевому типу."""
+    return str(status).lower() in ['true', 'completed', 'yes']
+
+
+def parse_call(data, now=None):
+    """
+    Проверяет данные нового звонка и возвращает аргументы для модели Call.
+    Ожидает ключи 'username' и 'status' (обязательные) и 'date' (необязательный, ISO 8601;
+    по умолчанию — now или текущее время).
+    """
+    if not isinstance(data, dict) or 'username' not in data or 'status' not in data:
+        raise QueryError("Username and status are required!")
+    if not isinstance(data['username'], str) or len(data['username']) > 80:
+        raise QueryError("Username must be a string up to 80 characters!")
+
+    # Используем текущую дату и время, если 'date' отсутствует
+    date = data.get('date')
+    if date:
+        try:
+            # Дата с часовым поясом приводится к UTC: колонка хранит время без пояса
+            date = naive_utc(datetime.fromisoformat(date))
+        except (TypeError, ValueError):
+            raise QueryError("Invalid date format. Use ISO 8601.")
+    else:
+        # Время без пояса: asyncpg не принимает дату с поясом для колонки timestamp without time zone
+        date = naive_utc(now or datetime.now(timezone.utc))
+
+    return {"username": data['username'], "date": date, "status": parse_status(data['status'])}
+
+
+def parse_batch(body, mimetype):
+    """
+    Разбирает тело пакетного запроса: JSON-массив или NDJSON (по одному объекту в строке,
+    Content-Type: application/x-ndjson).
+    Возвращает список элементов или None, если тело не разобрать; строки NDJSON с ошибкой попадают в список как None.
+    """
+    if mimetype in NDJSON_TYPES:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data if isinstance(data, list) else None
+
+
+def validate_batch(items):
+    """
+    Проверяет все звонки пакета за один проход.
+    Возвращает пары (индекс элемента, аргументы для модели Call) и ошибки по индексам элементов.
+    Звонкам без даты проставляется одно и то же время приёма пакета.
+    """
+    now = datetime.now(timezone.utc)
+    rows, errors = [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({"index": index, "message": "Item must be a JSON object!"})
+            continue
+        try:
+            row = parse_call(item, now)
+        except QueryError as error:
+            errors.append({"index": index, "message": str(error)})
+            continue
+        rows.append((index, row))
+    return rows, errors
+
+
+def batch_insert():
+    """Один многострочный INSERT звонков, возвращающий созданные записи в порядке строк."""
+    return insert(Call).returning(Call, sort_by_parameter_order=True)
+
+
+def batch_result(rows, calls, errors, serialize):
+    """Ответ пакетного запроса: созданные звонки с индексами исходных элементов и ошибки."""
+    return {
+        "inserted": len(calls),
+        "calls": [{"index": index, "call": serialize(call)} for (index, _), call in zip(rows, calls)],
+        "errors": errors,
+    }
+
+
+def encode_cursor(call):
+    """Курсор страницы — позиция последнего выданного звонка (date, id)."""
+    raw = f"{call.date.isoformat()}|{call.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    date, call_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(date), int(call_id)
+
+
+def history_query(args):
+    """
+    Строит запрос истории звонков по параметрам запроса, упорядоченный по (date, id).
+    Возвращает запрос и размер страницы (None — без пагинации).
+
+    Необязательные параметры:
+    - 'username': только звонки пользователя
+    - 'since', 'until': границы периода в формате ISO 8601
+    - 'status': только успешные ('true', 'completed', 'yes') или неуспешные (любое другое значение) звонки
+    - 'limit': размер страницы
+    - 'cursor': курсор из предыдущей страницы
+    """
+    query = select(Call)
+
+    username = args.get('username')
+    if username:
+        query = query.where(Call.username == username)
+
+    try:
+        since = args.get('since')
+        if since:
+            query = query.where(Call.date >= naive_utc(datetime.fromisoformat(since)))
+        until = args.get('until')
+        if until:
+            query = query.where(Call.date <= naive_utc(datetime.fromisoformat(until)))
+    except ValueError:
+        raise QueryError("Invalid date format. Use ISO 8601.")
+
+    status = args.get('status')
+    if status:
+        query = query.where(Call.status == parse_status(status))
+
+    limit = args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= CALL_PAGE_MAX_LIMIT:
+            raise QueryError(f"Limit must be between 1 and {CALL_PAGE_MAX_LIMIT}!")
+
+    cursor = args.get('cursor')
+    if cursor:
+        try:
+            cursor_date, cursor_id = decode_cursor(cursor)
+        except ValueError:
+            raise QueryError("Invalid cursor!")
+        # Keyset-пагинация: продолжаем строго после последнего выданного звонка
+        query = query.where(tuple_(Call.date, Call.id) > tuple_(cursor_date, cursor_id))
+
+    return query.order_by(Call.date, Call.id), limit
+
+
+def last_call_query():
+    # Обратный проход по индексу (date, id): читается одна строка, а не вся таблица
+    return select(Call).order_by(Call.date.desc(), Call.id.desc()).limit(1)
+
+
+def user_last_call_query(username):
+    return select(LastCall).where(LastCall.username == username)
+
+
+def naive_utc(date):
+    """Дата в UTC без часового пояса — в таком виде она хранится в колонке DateTime."""
+    if date is not None and date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def last_call_upsert(dialect_name, calls):
+    """
+    Запрос, обновляющий last_calls по только что записанным звонкам (после flush, чтобы были id и дата).
+    Запись пользователя заменяется, только если новый звонок не старше уже сохранённого.
+    """
+    latest = {}
+    for call in calls:
+        key = (naive_utc(call.date), call.id)
+        if call.username not in latest or key > latest[call.username][0]:
+            latest[call.username] = (key, call)
+    rows = [
+        {"username": username, "call_id": call.id, "date": date, "status": call.status}
+        for username, ((date, _), call) in latest.items()
+    ]
+
+    insert = postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+    statement = insert(LastCall).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=[LastCall.username],
+        set_={
+            "call_id": statement.excluded.call_id,
+            "date": statement.excluded.date,
+            "status": statement.excluded.status,
+        },
+        where=tuple_(LastCall.date, LastCall.call_id) <= tuple_(statement.excluded.date, statement.excluded.call_id),
+    )
+
+
+class LatestCallCache:
+    """
+    Последний звонок в памяти процесса.
+    Обновляется при каждой записи звонка этим процессом, а звонки, записанные другими процессами,
+    подхватываются из базы не реже раза в CALL_LAST_CACHE_TTL секунд.
+    """
+
+    def __init__(self, ttl=CALL_LAST_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.call = None
+        self.expires = 0.0
+
+    @staticmethod
+    def _key(call):
+        return naive_utc(call["date"]), call["id"]
+
+    def get(self):
+        """Закэшированный звонок (словарь id, username, date, status) или None, если кэш устарел."""
+        if self.call is not None and time.monotonic() < self.expires:
+            return self.call
+        return None
+
+    def set(self, call):
+        """Запоминает звонок, прочитанный из базы."""
+        with self.lock:
+            self.call = call
+            self.expires = time.monotonic() + self.ttl
+
+    def offer(self, call):
+        """Запоминает только что записанный звонок, если он новее закэшированного."""
+        with self.lock:
+            # Без прочитанного из базы значения не знаем, новее ли звонок уже записанных другими процессами
+            if self.call is not None and self._key(call) >= self._key(self.call):
+                self.call = call
+
+
+latest_call = LatestCallCache()
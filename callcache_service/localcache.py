@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+# Локальный (в памяти процесса) уровень кэша перед Redis.
+# Хранит уже готовое тело ответа (bytes), поэтому горячий ключ отдаётся без запроса в Redis и без
+# повторной сериализации JSON. Размер ограничен и числом записей, и суммарным объёмом в байтах.
+# Каждый процесс подписан на канал Redis: при записи или удалении ключа любым воркером
+# все воркеры удаляют этот ключ у себя, а TTL ограничивает устаревание, если сообщение потерялось.
+
+CACHE_LOCAL_SIZE = int(os.getenv("CACHE_LOCAL_SIZE", 10000))
+CACHE_LOCAL_MAX_BYTES = int(os.getenv("CACHE_LOCAL_MAX_BYTES", 64 * 1024 * 1024))
+CACHE_LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", 5))
+CACHE_INVALIDATION_CHANNEL = os.getenv("CACHE_INVALIDATION_CHANNEL", "callcache:invalidate")
+
+
+class LocalCache:
+    """LRU-кэш готовых ответов с TTL, ограничением по числу записей и по памяти."""
+
+    def __init__(self, redis, size=CACHE_LOCAL_SIZE, max_bytes=CACHE_LOCAL_MAX_BYTES, ttl=CACHE_LOCAL_TTL):
+        self.redis = redis
+        self.size = size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # PID процесса, в котором запущен подписчик: после fork воркера gunicorn его нужно запустить заново
+        self.listener_pid = None
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evicted_size": 0,
+            "evicted_memory": 0,
+            "invalidated": 0,
+            "invalidation_errors": 0,
+        }
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                **self.stats,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.size,
+                "max_bytes": self.max_bytes,
+                "listening": self.listener_pid == os.getpid(),
+            }
+
+    def get(self, key):
+        """Готовое тело ответа по ключу Redis или None."""
+        self._ensure_listener()
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            expires, body = entry
+            if expires < now:
+                self._remove(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return body
+
+    def set(self, key, body):
+        size = len(key) + len(body)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, body)
+            self.bytes += size
+            while len(self.entries) > self.size:
+                self._remove(next(iter(self.entries)))
+                self.stats["evicted_size"] += 1
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.stats["evicted_memory"] += 1
+
+    def invalidate(self, keys):
+        """Удаляет ключи в этом процессе и оповещает остальные процессы через Redis."""
+        keys = list(keys)
+        if not keys:
+            return
+        self._drop(keys)
+        try:
+            self.redis.publish(CACHE_INVALIDATION_CHANNEL, "\n".join(keys))
+        except RedisError:
+            self.stats["invalidation_errors"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(key) + len(entry[1])
+
+    def _drop(self, keys):
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self._remove(key)
+                    self.stats["invalidated"] += 1
+
+    def _ensure_listener(self):
+        if self.listener_pid == os.getpid():
+            return
+        with self.lock:
+            if self.listener_pid == os.getpid():
+                return
+            self.listener_pid = os.getpid()
+            # Кэш, унаследованный от мастер-процесса, мог устареть
+            self.entries.clear()
+            self.bytes = 0
+        threading.Thread(target=self._listen, name="cache-invalidation", daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                # Пока подписки не было, сообщения могли потеряться
+                self.clear()
+                while True:
+                    # Ждём сообщение не дольше секунды: блокирующее чтение упёрлось бы в socket_timeout клиента
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message["type"] == "message":
+                        self._drop(message["data"].decode().split("\n"))
+            except RedisError:
+                self.stats["invalidation_errors"] += 1
+                time.sleep(1)
@@ -1,11 +1,189 @@
-from flask import Flask, jsonify, request
-from redis import Redis
-import json  # Для сериализации данных
+from flask import Flask, Response, jsonify, request
+from datetime import datetime, timezone
+import os
+
+import metrics
+from localcache import LocalCache
+from redis_client import CLUSTER, create_client, pool_stats
+from serialization import decode, encode, encode_call
 
 app = Flask(__name__)
+# Время запросов по маршрутам и команд Redis, X-Request-ID и GET /metrics (см. metrics.py)
+metrics.init_app(app)
+
+# Настройка подключения к Redis: адрес из CACHE_URL, блокирующий пул соединений с таймаутами (см. redis_client.py)
+cache = create_client()
+# Локальный уровень кэша перед Redis: готовые ответы GET /cache/user и GET /cache/call
+local_cache = LocalCache(cache)
+
+# Максимальное число записей в одном пакетном запросе (mget и bulk)
+CACHE_BATCH_MAX_ITEMS = int(os.getenv("CACHE_BATCH_MAX_ITEMS", 10000))
+# Индекс звонков пользователя (сортированное множество 'calls:<username>', оценка — время звонка):
+# сколько последних звонков в нём хранится и сколько секунд живёт индекс неактивного пользователя
+CALL_INDEX_MAX_LEN = int(os.getenv("CALL_INDEX_MAX_LEN", 1000))
+CALL_INDEX_TTL = int(os.getenv("CALL_INDEX_TTL", 86400))
+# Размер ответа GET /cache/calls по умолчанию
+CALL_RANGE_DEFAULT_LIMIT = int(os.getenv("CALL_RANGE_DEFAULT_LIMIT", 100))
+
+def user_keys(data):
+    """
+    Ключи, под которыми хранится пользователь: основной 'user:<username>'
+    и дополнительные 'user:id:<id>' и 'user:phone:<phone>' для поиска по ID и телефону.
+    """
+    keys = [f"user:{data['username']}"]
+    if data.get('id') is not None:
+        keys.append(f"user:id:{data['id']}")
+    if data.get('phone'):
+        keys.append(f"user:phone:{data['phone']}")
+    return keys
+
+
+def user_lookup_key(args):
+    """Ключ для поиска пользователя по параметру запроса: 'username', 'id' или 'phone'."""
+    if args.get('username'):
+        return f"user:{args['username']}"
+    if args.get('id'):
+        return f"user:id:{args['id']}"
+    if args.get('phone'):
+        return f"user:phone:{args['phone']}"
+    return None
+
+
+def call_key(data):
+    """Ключ звонка 'call:<username>:<date>'."""
+    return f"call:{data['username']}:{data['date']}"
+
+
+def call_index_key(username):
+    return f"calls:{username}"
+
+
+def call_score(date):
+    """Время звонка в секундах для индекса; дата без часового пояса считается UTC. None — если дату не разобрать."""
+    try:
+        date = datetime.fromisoformat(date)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def index_calls(pipe, calls):
+    """
+    Добавляет команды индексации звонков в конвейер: ZADD в индекс пользователя,
+    обрезка до CALL_INDEX_MAX_LEN последних звонков и продление TTL индекса.
+    Звонки с датой не в формате ISO 8601 кэшируются, но в индекс не попадают.
+    """
+    by_user = {}
+    for data in calls:
+        score = call_score(data['date'])
+        if score is not None:
+            by_user.setdefault(data['username'], {})[data['date']] = score
+    for username, members in by_user.items():
+        key = call_index_key(username)
+        pipe.zadd(key, members)
+        pipe.zremrangebyrank(key, 0, -CALL_INDEX_MAX_LEN - 1)
+        if CALL_INDEX_TTL:
+            pipe.expire(key, CALL_INDEX_TTL)
+
+
+def validate_user(item):
+    """Проверяет пользователя для записи в кэш. Возвращает (данные без ttl, ttl, ошибка)."""
+    if not isinstance(item, dict) or 'username' not in item or 'phone' not in item:
+        return None, None, "Username and phone are required!"
+    data = dict(item)
+    return data, data.pop('ttl', None), None
+
+
+def validate_call(item):
+    """Проверяет звонок для записи в кэш. Возвращает (данные без ttl, ttl, ошибка)."""
+    if not isinstance(item, dict) or 'username' not in item or 'date' not in item or 'status' not in item:
+        return None, None, "Username, date, and status are required!"
+    data = dict(item)
+    return data, data.pop('ttl', None), None
+
+
+def read_items(field):
+    """Список из тела пакетного запроса (JSON-массив или объект с массивом под ключом field) или ответ с ошибкой."""
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get(field)
+    if not isinstance(data, list):
+        return None, (jsonify({"message": f"Expected a JSON array of {field}!"}), 400)
+    if len(data) > CACHE_BATCH_MAX_ITEMS:
+        return None, (jsonify({"message": f"Batch is too large! Maximum is {CACHE_BATCH_MAX_ITEMS} items."}), 413)
+    return data, None
+
+
+def set_many(entries, calls=()):
+    """
+    Записывает пары (ключ, значение, ttl) за один сетевой запрос к Redis:
+    записи без ttl — одним MSET, остальные — SET с EX в том же конвейере.
+    Звонки из calls в том же конвейере добавляются в индексы пользователей.
+    """
+    pipe = cache.pipeline(transaction=False)
+    index_calls(pipe, calls)
+    forever = {}
+    for key, value, ttl in entries:
+        if ttl:
+            pipe.set(key, value, ex=ttl)
+        else:
+            forever[key] = value
+    if forever and CLUSTER:
+        # В Redis Cluster MSET не работает с ключами из разных слотов
+        for key, value in forever.items():
+            pipe.set(key, value)
+    elif forever:
+        pipe.mset(forever)
+    pipe.execute()
+    local_cache.invalidate({key for key, _, _ in entries})
+
+
+def bulk_cache(field, validate, keys, serialize=encode, indexed=False):
+    """Общая часть пакетной записи: проверка элементов, один конвейер в Redis и ошибки по индексам."""
+    items, error = read_items(field)
+    if error:
+        return error
+
+    entries, valid, errors = [], [], []
+    for index, item in enumerate(items):
+        data, ttl, message = validate(item)
+        if message:
+            errors.append({"index": index, "message": message})
+            continue
+        value = serialize(data)
+        entries.extend((key, value, ttl) for key in keys(data))
+        valid.append(data)
+    if entries:
+        set_many(entries, valid if indexed else ())
+    return jsonify({"cached": len(valid), "errors": errors}), 201 if valid or not items else 400
+
+
+def cached_response(key, username=None):
+    """
+    Готовый ответ из локального кэша, иначе из Redis (и запоминаем его локально).
+    Возвращает None, если ключа нет. username нужен для звонков (см. serialization.decode).
+    """
+    body = local_cache.get(key)
+    if body is None:
+        value = cache.get(key)
+        if not value:
+            return None
+        # Декодируем значение и запоминаем уже готовое тело ответа
+        body = jsonify(decode(value, username)).get_data()
+        local_cache.set(key, body)
+    return Response(body, mimetype="application/json")
+
+
+def get_many(keys, usernames=None):
+    """Значения ключей одним MGET; отсутствующие — None. usernames — имена пользователей для ключей звонков."""
+    if not keys:
+        return []
+    values = cache.mget_nonatomic(keys) if CLUSTER else cache.mget(keys)
+    usernames = usernames or [None] * len(keys)
+    return [decode(value, username) if value else None for value, username in zip(values, usernames)]
 
-# Настройка подключения к Redis
-cache = Redis(port=6379, db=0)
 
 # Кэширование пользователя
 @app.post("/cache/user")
@@ -15,39 +193,99 @@ def cache_user():
     Ожидает JSON с ключами:
     - 'username': имя пользователя (обязательно)
     - 'phone': телефон пользователя (обязательно)
+    - 'id': ID пользователя (необязательно) — тогда пользователя можно найти и по ID
+    - 'ttl': время жизни записи в секундах (необязательно, по умолчанию без ограничения)
 
-    Сохраняет данные пользователя в формате JSON, используя ключ 'user:<username>'.
+    Сохраняет данные пользователя (в формате CACHE_CODEC, см. serialization.py), используя ключ 'user:<username>',
+    а также ключи 'user:id:<id>' и 'user:phone:<phone>'.
     """
     data = request.json
     if not data or 'username' not in data or 'phone' not in data:
         return jsonify({"message": "Username and phone are required!"}), 400
-    
-    # Сериализуем данные пользователя в JSON строку
-    user_data = json.dumps(data)
-    
-    # Сохраняем данные пользователя в Redis с уникальным ключом
-    cache.set(f"user:{data['username']}", user_data)
+
+    ttl = data.pop('ttl', None)
+    # Кодируем данные пользователя (см. serialization.py)
+    user_data = encode(data)
+
+    # Сохраняем данные пользователя в Redis под всеми ключами за один запрос. Без MULTI/EXEC:
+    # ключи попадают в разные слоты, и в режиме cluster транзакция по ним невозможна
+    pipe = cache.pipeline(transaction=False)
+    for key in user_keys(data):
+        pipe.set(key, user_data, ex=ttl)
+    pipe.execute()
+    local_cache.invalidate(user_keys(data))
     return jsonify({"message": f"User {data['username']} cached successfully!"}), 201
 
 @app.get("/cache/user")
 def get_user_from_cache():
     """
-    Извлекает данные пользователя из Redis по его имени.
-    Ожидает параметр 'username' в запросе.
+    Извлекает данные пользователя из Redis по его имени, ID или телефону.
+    Ожидает один из параметров 'username', 'id' или 'phone' в запросе.
     """
-    username = request.args.get('username')
-    if not username:
+    key = user_lookup_key(request.args)
+    if not key:
         return jsonify({"message": "Username is required to fetch user data!"}), 400
-    
+
     # Получаем данные пользователя из кэша
-    user_data = cache.get(f"user:{username}")
-    
+    response = cached_response(key)
+    if response:
+        return response
+
+    return jsonify({"message": f"User {key.split(':', 1)[1]} not found in cache!"}), 404
+
+@app.delete("/cache/user")
+def remove_user_from_cache():
+    """
+    Удаляет пользователя из кэша по имени, ID или телефону вместе со всеми его ключами.
+    Ожидает один из параметров 'username', 'id' или 'phone' в запросе.
+    """
+    key = user_lookup_key(request.args)
+    if not key:
+        return jsonify({"message": "Username, id or phone is required!"}), 400
+
+    keys = {key}
+    user_data = cache.get(key)
     if user_data:
-        # Десериализуем данные из JSON строки
-        user_data = json.loads(user_data)
-        return jsonify(user_data)
-    
-    return jsonify({"message": f"User {username} not found in cache!"}), 404
+        keys.update(user_keys(decode(user_data)))
+    cache.delete(*keys)
+    local_cache.invalidate(keys)
+    return jsonify({"message": "User removed from cache."}), 200
+
+
+@app.post("/cache/users/bulk")
+def cache_users_bulk():
+    """
+    Кэширует пачку пользователей за один запрос к Redis.
+    Ожидает JSON-массив (или {"users": [...]}) объектов как для POST /cache/user, у каждого может быть свой 'ttl'.
+    Возвращает количество закэшированных пользователей и ошибки по индексам элементов.
+    """
+    return bulk_cache("users", validate_user, user_keys)
+
+
+@app.post("/cache/users/mget")
+def get_users_from_cache():
+    """
+    Извлекает пачку пользователей одним MGET.
+    Ожидает JSON с любыми из списков 'usernames', 'ids' и 'phones'.
+    Возвращает те же списки в виде словарей значение -> данные пользователя (null, если его нет в кэше).
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"message": "Expected a JSON object with usernames, ids or phones!"}), 400
+
+    lookups = []
+    for field, prefix in (("usernames", "user:"), ("ids", "user:id:"), ("phones", "user:phone:")):
+        values = data.get(field) or []
+        if not isinstance(values, list):
+            return jsonify({"message": f"{field} must be a list!"}), 400
+        lookups.extend((field, str(value), f"{prefix}{value}") for value in values)
+    if len(lookups) > CACHE_BATCH_MAX_ITEMS:
+        return jsonify({"message": f"Batch is too large! Maximum is {CACHE_BATCH_MAX_ITEMS} items."}), 413
+
+    result = {field: {} for field in ("usernames", "ids", "phones") if field in data}
+    for (field, value, _), user in zip(lookups, get_many([key for _, _, key in lookups])):
+        result[field][value] = user
+    return jsonify(result)
 
 
 # Кэширование звонка
@@ -60,17 +298,21 @@ def cache_call():
     - 'date': дата звонка в ISO 8601 формате (обязательно)
     - 'status': статус звонка (обязательно)
 
-    Сохраняет данные звонка в формате JSON, используя ключ 'call:<username>:<date>'.
+    Сохраняет данные звонка (по возможности в компактной схеме, см. serialization.py), используя ключ 'call:<username>:<date>'.
     """
     data = request.json
     if not data or 'username' not in data or 'date' not in data or 'status' not in data:
         return jsonify({"message": "Username, date, and status are required!"}), 400
     
-    # Сериализуем данные звонка в JSON строку
-    call_data = json.dumps(data)
+    # Кодируем данные звонка
+    call_data = encode_call(data)
     
-    # Сохраняем данные звонка в Redis с уникальным ключом
-    cache.set(f"call:{data['username']}:{data['date']}", call_data)
+    # Сохраняем данные звонка в Redis с уникальным ключом и добавляем его в индекс пользователя
+    pipe = cache.pipeline(transaction=False)
+    pipe.set(call_key(data), call_data)
+    index_calls(pipe, [data])
+    pipe.execute()
+    local_cache.invalidate([call_key(data)])
     return jsonify({"message": f"Call data for {data['username']} cached successfully!"}), 201
 
 @app.get("/cache/call")
@@ -85,12 +327,87 @@ def get_call_result_from_cache():
         return jsonify({"message": "Username and date are required to fetch call data!"}), 400
     
     # Получаем данные звонка из кэша
-    call_data = cache.get(f"call:{username}:{date}")
-    
-    if call_data:
-        # Десериализуем данные из JSON строки
-        call_data = json.loads(call_data)
-        return jsonify(call_data)
-    
+    response = cached_response(f"call:{username}:{date}", username)
+    if response:
+        return response
+
     return jsonify({"message": f"Call data for {username} on {date} not found in cache!"}), 404
 
+
+@app.post("/cache/calls/bulk")
+def cache_calls_bulk():
+    """
+    Кэширует пачку звонков за один запрос к Redis.
+    Ожидает JSON-массив (или {"calls": [...]}) объектов как для POST /cache/call, у каждого может быть свой 'ttl'.
+    Возвращает количество закэшированных звонков и ошибки по индексам элементов.
+    """
+    return bulk_cache("calls", validate_call, lambda data: [call_key(data)], encode_call, indexed=True)
+
+
+@app.post("/cache/calls/mget")
+def get_calls_from_cache():
+    """
+    Извлекает пачку звонков одним MGET.
+    Ожидает JSON-массив (или {"calls": [...]}) объектов с ключами 'username' и 'date'.
+    Возвращает {"calls": [...]} в том же порядке; звонки, которых нет в кэше, — null.
+    """
+    items, error = read_items("calls")
+    if error:
+        return error
+    if not all(isinstance(item, dict) and item.get('username') and item.get('date') for item in items):
+        return jsonify({"message": "Username and date are required for every call!"}), 400
+    return jsonify({"calls": get_many([call_key(item) for item in items], [item['username'] for item in items])})
+
+
+@app.get("/cache/calls")
+def get_calls_range_from_cache():
+    """
+    Возвращает звонки пользователя за период из индекса 'calls:<username>', без обращения к call_service.
+    Параметры:
+    - 'username' (обязательно)
+    - 'since', 'until': границы периода в формате ISO 8601 (необязательно)
+    - 'limit': максимальное число звонков (по умолчанию CALL_RANGE_DEFAULT_LIMIT)
+
+    Звонки упорядочены от новых к старым, чтобы limit оставлял последние звонки периода.
+    Это намеренное отличие от истории звонков call_service (GET /call/history/),
+    которая упорядочена по возрастанию (date, id).
+    В индексе лежат только последние CALL_INDEX_MAX_LEN звонков пользователя.
+    """
+    username = request.args.get('username')
+    if not username:
+        return jsonify({"message": "Username is required to fetch calls!"}), 400
+
+    bounds = []
+    for name, default in (('since', '-inf'), ('until', '+inf')):
+        value = request.args.get(name)
+        score = call_score(value) if value else default
+        if score is None:
+            return jsonify({"message": "Invalid date format. Use ISO 8601."}), 400
+        bounds.append(score)
+
+    try:
+        limit = int(request.args.get('limit', CALL_RANGE_DEFAULT_LIMIT))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= CACHE_BATCH_MAX_ITEMS:
+        return jsonify({"message": f"Limit must be between 1 and {CACHE_BATCH_MAX_ITEMS}!"}), 400
+
+    index_key = call_index_key(username)
+    since, until = bounds
+    dates = [date.decode() for date in cache.zrevrangebyscore(index_key, until, since, start=0, num=limit)]
+    calls = get_many([call_key({"username": username, "date": date}) for date in dates], [username] * len(dates))
+
+    # Звонки, истёкшие или удалённые из кэша, убираем из индекса
+    expired = [date for date, call in zip(dates, calls) if call is None]
+    if expired:
+        cache.zrem(index_key, *expired)
+    return jsonify([call for call in calls if call is not None])
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    """
+    Состояние локального уровня кэша этого процесса (попадания, промахи, вытеснения и объём)
+    и пула соединений к Redis (занятые соединения, ожидание и исчерпание пула).
+    """
+    return jsonify({**local_cache.snapshot(), "redis": pool_stats(cache)})
@@ -0,0 +1,68 @@
+import os
+import time
+import uuid
+
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Gauge, Histogram, generate_latest, multiprocess
+
+# Метрики сервиса в формате Prometheus (GET /metrics).
+# Под gunicorn каждый воркер пишет метрики в файлы каталога PROMETHEUS_MULTIPROC_DIR (его задаёт entrypoint.sh),
+# а /metrics складывает их по всем воркерам. Идентификатор запроса X-Request-ID принимается от шлюза
+# (или создаётся) и возвращается в ответе, gunicorn пишет его в журнал вместе со временем ответа.
+
+REQUEST_ID_HEADER = "X-Request-ID"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Время обработки запроса до начала ответа",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REDIS_COMMAND_LATENCY = Histogram(
+    "redis_command_duration_seconds",
+    "Время выполнения команды Redis (конвейер — одна команда PIPELINE)",
+    ["command"],
+    buckets=LATENCY_BUCKETS,
+)
+REDIS_POOL_CONNECTIONS = Gauge(
+    "redis_pool_connections_in_use",
+    "Соединения пула Redis, занятые запросами",
+    multiprocess_mode="livesum",
+)
+
+
+def registry():
+    """Реестр для ответа /metrics: под gunicorn — сумма по файлам всех воркеров."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        collector_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collector_registry)
+        return collector_registry
+    return REGISTRY
+
+
+def init_app(app):
+    """Измерение времени запросов по маршрутам, X-Request-ID и маршрут GET /metrics."""
+
+    @app.before_request
+    def start_request():
+        g.request_started = time.perf_counter()
+        g.request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            # Шаблон маршрута из правила Flask, а 404 собираются в одну строку 'unmatched'
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            REQUEST_LATENCY.labels(request.method, route, str(response.status_code)).observe(time.perf_counter() - started)
+        response.headers[REQUEST_ID_HEADER] = g.get("request_id", "")
+        return response
+
+    @app.get("/metrics")
+    def metrics():
+        return Response(generate_latest(registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def observe_redis(command, started):
+    REDIS_COMMAND_LATENCY.labels(command).observe(time.perf_counter() - started)
@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+
+from redis import BlockingConnectionPool, Redis
+from redis.client import Pipeline
+from redis.cluster import RedisCluster
+from redis.connection import parse_url
+from redis.exceptions import ConnectionError
+from redis.sentinel import Sentinel
+
+from metrics import REDIS_POOL_CONNECTIONS, observe_redis
+
+# Подключение к Redis для callcache_service.
+# Адрес берётся из CACHE_URL (redis://, rediss:// или unix:///path/redis.sock?db=0).
+# В обычном режиме используется блокирующий пул: при исчерпании соединений запрос ждёт свободное
+# соединение не дольше REDIS_POOL_TIMEOUT секунд, а не открывает новые без ограничения.
+# REDIS_MODE=cluster подключается к Redis Cluster, REDIS_MODE=sentinel — к мастеру через Sentinel.
+# Время каждой команды (и каждого конвейера целиком) попадает в метрику redis_command_duration_seconds.
+
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+REDIS_MODE = os.getenv("REDIS_MODE", "standalone")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 2))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", 1))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+# Для REDIS_MODE=sentinel: адреса Sentinel через запятую (host:port) и имя мастера
+REDIS_SENTINELS = os.getenv("REDIS_SENTINELS", "")
+REDIS_SENTINEL_SERVICE = os.getenv("REDIS_SENTINEL_SERVICE", "mymaster")
+
+CLUSTER = REDIS_MODE == "cluster"
+
+
+def connection_options():
+    return {
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+    }
+
+
+class MeteredConnectionPool(BlockingConnectionPool):
+    """Блокирующий пул соединений, который считает ожидание свободного соединения и его исчерпание."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics_lock = threading.Lock()
+        self.metrics = {
+            "in_use": 0,
+            "max_in_use": 0,
+            "acquired": 0,
+            "exhausted": 0,
+            "wait_time_total": 0.0,
+            "max_wait_time": 0.0,
+        }
+
+    def get_connection(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except ConnectionError as error:
+            if str(error) == "No connection available.":
+                with self.metrics_lock:
+                    self.metrics["exhausted"] += 1
+            raise
+        waited = time.monotonic() - started
+        with self.metrics_lock:
+            metrics = self.metrics
+            metrics["acquired"] += 1
+            metrics["in_use"] += 1
+            metrics["max_in_use"] = max(metrics["max_in_use"], metrics["in_use"])
+            metrics["wait_time_total"] += waited
+            metrics["max_wait_time"] = max(metrics["max_wait_time"], waited)
+            REDIS_POOL_CONNECTIONS.set(metrics["in_use"])
+        return connection
+
+    def release(self, connection):
+        with self.metrics_lock:
+            self.metrics["in_use"] = max(self.metrics["in_use"] - 1, 0)
+            REDIS_POOL_CONNECTIONS.set(self.metrics["in_use"])
+        super().release(connection)
+
+    def stats(self):
+        with self.metrics_lock:
+            metrics = dict(self.metrics)
+        acquired = metrics["acquired"]
+        metrics["avg_wait_time"] = metrics["wait_time_total"] / acquired if acquired else 0.0
+        return {**metrics, "created": len(self._connections), "max_connections": self.max_connections}
+
+
+def command_name(args):
+    name = args[0]
+    return (name.decode() if isinstance(name, bytes) else str(name)).upper()
+
+
+class MeteredPipeline(Pipeline):
+    """Конвейер, время выполнения которого измеряется целиком."""
+
+    def execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            observe_redis("PIPELINE", started)
+
+
+class MeteredRedis(Redis):
+    """Клиент Redis, измеряющий время каждой команды."""
+
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            observe_redis(command_name(args), started)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MeteredPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class MeteredRedisCluster(RedisCluster):
+    """Клиент Redis Cluster, измеряющий время каждой команды (конвейеры кластера не измеряются)."""
+
+    def execute_command(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **kwargs)
+        finally:
+            observe_redis(command_name(args), started)
+
+
+def create_client(url=CACHE_URL):
+    """Клиент Redis согласно REDIS_MODE."""
+    if CLUSTER:
+        return MeteredRedisCluster.from_url(url, max_connections=REDIS_MAX_CONNECTIONS, **connection_options())
+    if REDIS_MODE == "sentinel":
+        sentinels = [
+            (host, int(port))
+            for host, port in (address.rsplit(":", 1) for address in REDIS_SENTINELS.split(",") if address)
+        ]
+        # Из CACHE_URL берутся только база и учётные данные, адрес мастера сообщает Sentinel
+        credentials = {key: value for key, value in parse_url(url).items() if key in ("db", "username", "password")}
+        sentinel = Sentinel(sentinels, **connection_options())
+        return sentinel.master_for(
+            REDIS_SENTINEL_SERVICE, redis_class=MeteredRedis, max_connections=REDIS_MAX_CONNECTIONS,
+            **connection_options(), **credentials,
+        )
+    pool = MeteredConnectionPool.from_url(
+        url,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        **connection_options(),
+    )
+    return MeteredRedis(connection_pool=pool)
+
+
+def pool_stats(client):
+    """Состояние пула соединений для мониторинга."""
+    pool = getattr(client, "connection_pool", None)
+    if isinstance(pool, MeteredConnectionPool):
+        return {"mode": REDIS_MODE, **pool.stats()}
+    return {"mode": REDIS_MODE}
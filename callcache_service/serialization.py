@@ -0,0 +1,108 @@
+import json
+import os
+import struct
+import zlib
+from datetime import datetime, timedelta
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Форматы значений в Redis.
+# Первый байт значения — версия формата, поэтому формат можно менять постепенно: читаются все версии,
+# а записываются новые значения в формате CACHE_CODEC. Значения без байта версии (записанные до появления
+# кодеков) начинаются с '{' и читаются как JSON.
+#
+# Звонки вида {"username", "date", "status"} со статусом-булевым значением и датой без часового пояса
+# хранятся в компактной схеме: время звонка в микросекундах (int64) и бит статуса — 10 байт вместо ~70.
+# Имя пользователя не хранится: оно уже есть в ключе 'call:<username>:<date>' и передаётся при чтении.
+
+FORMAT_JSON = 0x01
+FORMAT_MSGPACK = 0x02
+FORMAT_CALL = 0x03
+# Флаг в байте версии: значение сжато zlib
+COMPRESSED = 0x80
+
+# 'msgpack' (если пакет установлен, иначе JSON) или 'json'
+CACHE_CODEC = os.getenv("CACHE_CODEC", "msgpack")
+# Сжимать значения длиннее стольких байт (0 — не сжимать)
+CACHE_COMPRESS_MIN_BYTES = int(os.getenv("CACHE_COMPRESS_MIN_BYTES", 1024))
+CACHE_COMPRESS_LEVEL = int(os.getenv("CACHE_COMPRESS_LEVEL", 1))
+
+EPOCH = datetime(1970, 1, 1)
+CALL_STRUCT = struct.Struct(">qB")
+
+
+class CodecError(ValueError):
+    """Значение в Redis записано в неизвестном формате."""
+
+
+def default_format():
+    if CACHE_CODEC == "msgpack" and msgpack is not None:
+        return FORMAT_MSGPACK
+    return FORMAT_JSON
+
+
+def pack(version, payload):
+    """Добавляет байт версии и при необходимости сжимает значение."""
+    if CACHE_COMPRESS_MIN_BYTES and len(payload) >= CACHE_COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(payload, CACHE_COMPRESS_LEVEL)
+        if len(compressed) < len(payload):
+            return bytes([version | COMPRESSED]) + compressed
+    return bytes([version]) + payload
+
+
+def encode(data):
+    """Кодирует запись (словарь) в формате CACHE_CODEC."""
+    version = default_format()
+    if version == FORMAT_MSGPACK:
+        return pack(version, msgpack.packb(data, use_bin_type=True))
+    return pack(version, json.dumps(data, separators=(",", ":")).encode())
+
+
+def compact_call_date(data):
+    """Дата звонка для компактной схемы или None, если звонок в неё не укладывается без потерь."""
+    if set(data) != {"username", "date", "status"} or not isinstance(data["status"], bool):
+        return None
+    try:
+        date = datetime.fromisoformat(data["date"])
+    except (TypeError, ValueError):
+        return None
+    # Дата должна восстанавливаться из числа в точности в исходную строку
+    if date.tzinfo is not None or date.isoformat() != data["date"]:
+        return None
+    return date
+
+
+def encode_call(data):
+    """Кодирует звонок: в компактной схеме, если возможно, иначе как обычную запись."""
+    date = compact_call_date(data)
+    if date is None:
+        return encode(data)
+    micros = (date - EPOCH) // timedelta(microseconds=1)
+    return bytes([FORMAT_CALL]) + CALL_STRUCT.pack(micros, data["status"])
+
+
+def decode(value, username=None):
+    """
+    Декодирует значение из Redis в словарь.
+    username нужен для звонков в компактной схеме — имя пользователя берётся из ключа.
+    """
+    if value[:1] == b"{":
+        return json.loads(value)
+    version, payload = value[0], value[1:]
+    if version & COMPRESSED:
+        version &= ~COMPRESSED
+        payload = zlib.decompress(payload)
+    if version == FORMAT_JSON:
+        return json.loads(payload)
+    if version == FORMAT_MSGPACK:
+        if msgpack is None:
+            raise CodecError("msgpack is not installed")
+        return msgpack.unpackb(payload, raw=False)
+    if version == FORMAT_CALL:
+        micros, status = CALL_STRUCT.unpack(payload)
+        date = EPOCH + timedelta(microseconds=micros)
+        return {"username": username, "date": date.isoformat(), "status": bool(status)}
+    raise CodecError(f"Unknown cache value format {version}")
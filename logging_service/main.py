@@ -1,16 +1,70 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from sqlalchemy import insert, select, tuple_
+import base64
+import json
 import os
 import dotenv
 
 app = Flask(__name__)
 
-from models import UserLog,CallLog,start_db,session,datetime
+from models import UserLog,CallLog,Session,engine,start_db,session,datetime,current_utc_time
+from migrations import LOG_PARTITIONING, maintain_partitions, migrate
+from stats import CALL_STATS_MAX_BUCKETS, GRANULARITIES, call_stats, prune, rebuild, record_call_stats
+import click
+import metrics
 
-@app.before_request
-def create_tables():
+# Время запросов по маршрутам и к базе, X-Request-ID и GET /metrics (см. metrics.py)
+metrics.init_app(app)
+metrics.instrument_engine(engine)
+
+# Схема создаётся один раз при старте сервиса, а не перед каждым запросом.
+# При DB_CREATE_ON_STARTUP=false схемой управляет только команда `flask migrate`.
+DB_CREATE_ON_STARTUP = os.getenv("DB_CREATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+# Секционированные таблицы создаются только командой `flask migrate`
+if DB_CREATE_ON_STARTUP and not LOG_PARTITIONING:
     start_db()
 
 
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Закрываем сессию запроса и возвращаем соединение в пул."""
+    session.remove()
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Создаёт таблицы и индексы логов; при LOG_PARTITIONING=true переводит их на помесячные секции."""
+    backfilled = migrate()
+    if backfilled is not None:
+        print(f"Call stats rebuilt from {backfilled} call logs.")
+    print("Migration completed.")
+
+
+@app.cli.command("partitions")
+def partitions_command():
+    """Создаёт секции логов на LOG_PARTITIONS_AHEAD месяцев вперёд и удаляет старше LOG_RETENTION_MONTHS."""
+    created, dropped = maintain_partitions()
+    print(f"Created partitions: {', '.join(created) or '-'}")
+    print(f"Dropped partitions: {', '.join(dropped) or '-'}")
+
+
+@app.cli.command("stats-rebuild")
+@click.option("--since", default=None, help="Пересчитать начиная с даты YYYY-MM-DD (по умолчанию — всю статистику).")
+def stats_rebuild_command(since):
+    """Пересчитывает статистику звонков call_stats по логам call_logs."""
+    with engine.begin() as connection:
+        processed = rebuild(connection, datetime.strptime(since, "%Y-%m-%d") if since else None)
+    print(f"Rebuilt call stats from {processed} call logs.")
+
+
+@app.cli.command("stats-prune")
+def stats_prune_command():
+    """Удаляет поминутную статистику звонков старше CALL_STATS_MINUTE_RETENTION_DAYS суток."""
+    with engine.begin() as connection:
+        deleted = prune(connection, current_utc_time())
+    print(f"Deleted {deleted} minute stats rows.")
+
+
 # Настройки подключения к базе данных
 
 # Запись лога пользователя
@@ -49,18 +103,163 @@ def set_log_call():
     # Создаём новый лог для звонка
     log = CallLog(username=data['username'], call_duration=data['call_duration'], status=data['status'])
     session.add(log)
-    session.commit()
+    try:
+        session.flush()  # Получаем время записи
+        # Статистика звонков обновляется в той же транзакции
+        record_call_stats(session, [(log.username, log.call_duration, log.status, log.timestamp)])
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
     return jsonify({"message": f"Call log for {data['username']} recorded!"}), 201
 
 
-# Получение логов звонков за период времени
-@app.get("/log/calls/")
-def calls():
+# Максимальное количество записей в одном пакетном запросе
+LOG_BATCH_MAX_ITEMS = int(os.getenv("LOG_BATCH_MAX_ITEMS", 10000))
+
+
+def read_batch():
     """
-    Извлекает логи звонков за заданный период времени.
+    Читает тело пакетного запроса: JSON-массив или NDJSON (по одному объекту в строке,
+    Content-Type: application/x-ndjson).
+    Возвращает список элементов; строки NDJSON, которые не удалось разобрать, попадают в список как None.
+    """
+    if request.mimetype in ("application/x-ndjson", "application/jsonlines"):
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+    data = request.get_json(silent=True)
+    return data if isinstance(data, list) else None
+
+
+def validate_user_log(item):
+    """Проверяет элемент пакета логов пользователей. Возвращает (строка для вставки, ошибка)."""
+    if not isinstance(item, dict):
+        return None, "Item must be a JSON object!"
+    username, action = item.get('username'), item.get('action')
+    if not isinstance(username, str) or not username or len(username) > 80:
+        return None, "Username is required (string up to 80 characters)!"
+    if not isinstance(action, str) or not action or len(action) > 200:
+        return None, "Action is required (string up to 200 characters)!"
+    return {"username": username, "action": action}, None
+
+
+def validate_call_log(item):
+    """Проверяет элемент пакета логов звонков. Возвращает (строка для вставки, ошибка)."""
+    if not isinstance(item, dict):
+        return None, "Item must be a JSON object!"
+    username, duration, status = item.get('username'), item.get('call_duration'), item.get('status')
+    if not isinstance(username, str) or not username or len(username) > 80:
+        return None, "Username is required (string up to 80 characters)!"
+    if isinstance(duration, bool) or not isinstance(duration, int) or duration < 0:
+        return None, "Call_duration is required (non-negative integer)!"
+    if isinstance(status, bool):
+        # Так же, как Postgres приводит boolean к строке при одиночной записи
+        status = "true" if status else "false"
+    if not isinstance(status, str) or not status or len(status) > 50:
+        return None, "Status is required (string up to 50 characters)!"
+    return {"username": username, "call_duration": duration, "status": status}, None
+
+
+def insert_batch(model, validate, after_insert=None):
+    """
+    Проверяет все элементы пакета и вставляет корректные одним многострочным INSERT в одной транзакции.
+    after_insert(rows) вызывается в той же транзакции после вставки.
+    Возвращает количество вставленных записей и ошибки по индексам элементов.
+    """
+    items = read_batch()
+    if items is None:
+        return jsonify({"message": "Expected a JSON array or NDJSON body!"}), 400
+    if len(items) > LOG_BATCH_MAX_ITEMS:
+        return jsonify({"message": f"Batch is too large! Maximum is {LOG_BATCH_MAX_ITEMS} items."}), 413
+
+    rows, errors = [], []
+    for index, item in enumerate(items):
+        row, error = validate(item)
+        if error:
+            errors.append({"index": index, "message": error})
+        else:
+            rows.append(row)
+
+    if rows:
+        # Время записи одно на весь пакет, чтобы оно было известно до вставки
+        timestamp = current_utc_time()
+        for row in rows:
+            row["timestamp"] = timestamp
+        try:
+            session.execute(insert(model), rows)
+            if after_insert:
+                after_insert(rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    return jsonify({"inserted": len(rows), "errors": errors}), 201 if rows or not items else 400
+
+
+# Пакетная запись логов пользователей
+@app.post("/log/user/batch")
+def set_log_user_batch():
+    """
+    Записывает пачку логов действий пользователей одним запросом к базе данных.
+    Ожидает JSON-массив или NDJSON, каждый элемент — как для /log/user.
+    Возвращает количество записанных логов и ошибки для некорректных элементов.
+    """
+    return insert_batch(UserLog, validate_user_log)
+
+
+# Пакетная запись логов звонков
+@app.post("/log/call/batch")
+def set_log_call_batch():
+    """
+    Записывает пачку логов звонков одним запросом к базе данных.
+    Ожидает JSON-массив или NDJSON, каждый элемент — как для /log/call.
+    Возвращает количество записанных логов и ошибки для некорректных элементов.
+    """
+    return insert_batch(CallLog, validate_call_log, record_call_log_stats)
+
+
+def record_call_log_stats(rows):
+    record_call_stats(session, [
+        (row["username"], row["call_duration"], row["status"], row["timestamp"]) for row in rows
+    ])
+
+
+# Размер порции строк, которую серверный курсор базы данных отдаёт за раз
+LOG_STREAM_CHUNK = int(os.getenv("LOG_STREAM_CHUNK", 1000))
+# Максимальный размер страницы при постраничной выдаче
+LOG_PAGE_MAX_LIMIT = int(os.getenv("LOG_PAGE_MAX_LIMIT", 10000))
+
+
+def encode_cursor(log):
+    """Курсор страницы — позиция последней выданной записи (timestamp, id)."""
+    raw = f"{log.timestamp.isoformat()}|{log.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    timestamp, log_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(timestamp), int(log_id)
+
+
+def query_logs(model, serialize):
+    """
+    Выдаёт логи модели за период времени, упорядоченные по (timestamp, id).
     Ожидает параметры:
-    - 'start_date': начало периода (в формате YYYY-MM-DDTHH:MM:SS)
-    - 'end_date': конец периода (в формате YYYY-MM-DDTHH:MM:SS)
+    - 'start_date', 'end_date': границы периода (в формате YYYY-MM-DDTHH:MM:SS)
+    - 'limit' (необязательный): размер страницы; курсор следующей страницы возвращается в заголовке X-Next-Cursor
+    - 'cursor' (необязательный): курсор из предыдущей страницы
+    - 'format' (необязательный): 'ndjson' — по одной записи в строке вместо JSON-массива
+
+    Записи читаются серверным курсором порциями по LOG_STREAM_CHUNK и сразу отправляются клиенту,
+    поэтому потребление памяти не зависит от размера периода.
     """
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
@@ -74,31 +273,112 @@ def calls():
     except ValueError:
         return jsonify({"message": "Invalid date format! Use YYYY-MM-DDTHH:MM:SS."}), 400
 
-    # Используем session.query() для получения данных
-    logs = session.query(CallLog).filter(
-        CallLog.timestamp >= start_date,
-        CallLog.timestamp <= end_date
-    ).all()
+    # Некорректный limit — ошибка, а не выдача всего периода без пагинации
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= LOG_PAGE_MAX_LIMIT:
+            return jsonify({"message": f"Limit must be between 1 and {LOG_PAGE_MAX_LIMIT}!"}), 400
 
-    if not logs:
+    query = select(model).where(
+        model.timestamp >= start_date,
+        model.timestamp <= end_date
+    )
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor_timestamp, cursor_id = decode_cursor(cursor)
+        except ValueError:
+            return jsonify({"message": "Invalid cursor!"}), 400
+        # Keyset-пагинация: продолжаем строго после последней выданной записи
+        query = query.where(tuple_(model.timestamp, model.id) > tuple_(cursor_timestamp, cursor_id))
+
+    query = query.order_by(model.timestamp, model.id)
+    headers = {}
+    # Отдельная сессия живёт, пока ответ не будет отправлен целиком:
+    # сессия запроса закрывается раньше, чем начинается потоковая отправка
+    stream_session = Session()
+    if limit is not None:
+        # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+        page = stream_session.scalars(query.limit(limit + 1)).all()
+        if len(page) > limit:
+            page = page[:limit]
+            headers["X-Next-Cursor"] = encode_cursor(page[-1])
+        rows = iter(page)
+    else:
+        rows = iter(stream_session.scalars(query.execution_options(yield_per=LOG_STREAM_CHUNK)))
+
+    first = next(rows, None)
+    if first is None:
+        stream_session.close()
+        if cursor:
+            # Пустая последняя страница — не ошибка
+            return jsonify([])
         return jsonify({"message": "No logs found for the given period."}), 404
 
-    return jsonify([{
+    ndjson = request.args.get('format') == 'ndjson'
+
+    def generate():
+        try:
+            if not ndjson:
+                yield "["
+            yield app.json.dumps(serialize(first))
+            for log in rows:
+                yield "\n" if ndjson else ","
+                yield app.json.dumps(serialize(log))
+            yield "\n" if ndjson else "]"
+        finally:
+            stream_session.close()
+
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(generate(), mimetype=mimetype, headers=headers)
+
+
+def serialize_call_log(log):
+    return {
         "username": log.username,
         "call_duration": log.call_duration,
         "status": log.status,
         "timestamp": log.timestamp.strftime("%Y-%m-%dT%H:%M:%S")
-    } for log in logs])
+    }
 
 
-# Получение логов пользователей за период времени
-@app.get("/log/users/")
-def users():
+def serialize_user_log(log):
+    return {
+        "username": log.username,
+        "action": log.action,
+        "timestamp": log.timestamp.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+
+# Получение логов звонков за период времени
+@app.get("/log/calls/")
+def calls():
     """
-    Извлекает логи действий пользователей за заданный период времени.
+    Извлекает логи звонков за заданный период времени.
     Ожидает параметры:
     - 'start_date': начало периода (в формате YYYY-MM-DDTHH:MM:SS)
     - 'end_date': конец периода (в формате YYYY-MM-DDTHH:MM:SS)
+    - 'limit', 'cursor', 'format' (необязательные): см. query_logs
+    """
+    return query_logs(CallLog, serialize_call_log)
+
+
+# Статистика звонков за период
+@app.get("/log/calls/stats")
+def calls_stats():
+    """
+    Возвращает предагрегированную статистику звонков за период из таблицы call_stats.
+    Ожидает параметры:
+    - 'start_date', 'end_date': границы периода (в формате YYYY-MM-DDTHH:MM:SS)
+    - 'interval' (необязательный): minute, hour (по умолчанию) или day
+    - 'username' (необязательный): статистика одного пользователя
+    - 'group_by' (необязательный): через запятую interval и/или user (по умолчанию оба)
+    - 'limit' (необязательный): сколько пользователей с наибольшим числом звонков вернуть (по умолчанию 100)
     """
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
@@ -112,18 +392,42 @@ def users():
     except ValueError:
         return jsonify({"message": "Invalid date format! Use YYYY-MM-DDTHH:MM:SS."}), 400
 
-    logs = session.query(UserLog).filter(
-        UserLog.timestamp >= start_date,
-        UserLog.timestamp <= end_date
-    ).all()
+    interval = request.args.get('interval', 'hour')
+    if interval not in GRANULARITIES:
+        return jsonify({"message": f"Interval must be one of: {', '.join(GRANULARITIES)}!"}), 400
+    if (end_date - start_date) / GRANULARITIES[interval] > CALL_STATS_MAX_BUCKETS:
+        return jsonify({"message": f"Too many intervals! Maximum is {CALL_STATS_MAX_BUCKETS}."}), 400
 
-    if not logs:
-        return jsonify({"message": "No logs found for the given period."}), 404
+    group_by = [part for part in request.args.get('group_by', 'interval,user').split(',') if part]
+    if any(part not in ('interval', 'user') for part in group_by):
+        return jsonify({"message": "Group_by must contain only interval and user!"}), 400
 
-    return jsonify([{
-        "username": log.username,
-        "action": log.action,
-        "timestamp": log.timestamp.strftime("%Y-%m-%dT%H:%M:%S")
-    } for log in logs])
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= LOG_PAGE_MAX_LIMIT:
+        return jsonify({"message": f"Limit must be between 1 and {LOG_PAGE_MAX_LIMIT}!"}), 400
+
+    username = request.args.get('username')
+    result = call_stats(session, interval, start_date, end_date, username, group_by, limit)
+    return jsonify({
+        "interval": interval,
+        "start_date": start_date.strftime("%Y-%m-%dT%H:%M:%S"),
+        "end_date": end_date.strftime("%Y-%m-%dT%H:%M:%S"),
+        **({"username": username} if username is not None else {}),
+        **result,
+    })
 
 
+# Получение логов пользователей за период времени
+@app.get("/log/users/")
+def users():
+    """
+    Извлекает логи действий пользователей за заданный период времени.
+    Ожидает параметры:
+    - 'start_date': начало периода (в формате YYYY-MM-DDTHH:MM:SS)
+    - 'end_date': конец периода (в формате YYYY-MM-DDTHH:MM:SS)
+    - 'limit', 'cursor', 'format' (необязательные): см. query_logs
+    """
+    return query_logs(UserLog, serialize_user_log)
@@ -0,0 +1,186 @@
+from datetime import date
+import os
+import re
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from models import Base, engine
+from stats import backfill
+
+# Управление схемой логов.
+# Таблицы user_logs и call_logs только дописываются и растут бесконечно, поэтому в Postgres
+# их можно хранить секционированными по месяцам (PARTITION BY RANGE (timestamp)):
+# выборка за период читает только нужные секции, а старые месяцы удаляются целиком через DROP TABLE.
+#
+# Запуск: flask --app main migrate (создание схемы и индексов) и flask --app main partitions
+# (по расписанию: создание секций на будущие месяцы и удаление устаревших).
+
+# Включить помесячное секционирование (только для PostgreSQL)
+LOG_PARTITIONING = os.getenv("LOG_PARTITIONING", "false").lower() in ("1", "true", "yes")
+# На сколько месяцев вперёд заранее создавать секции
+LOG_PARTITIONS_AHEAD = int(os.getenv("LOG_PARTITIONS_AHEAD", 3))
+# Сколько месяцев хранить логи (0 — хранить всё)
+LOG_RETENTION_MONTHS = int(os.getenv("LOG_RETENTION_MONTHS", 0))
+
+PARTITIONED_TABLES = ("user_logs", "call_logs")
+PARTITION_NAME = re.compile(r"^(?P<table>\w+)_y(?P<year>\d{4})m(?P<month>\d{2})$")
+
+
+def add_months(day, months):
+    """Первое число месяца, отстоящего от day на months месяцев."""
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_y{month.year:04d}m{month.month:02d}"
+
+
+def is_partitioned(connection, table):
+    return connection.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = :table"
+    ), {"table": table}).scalar() is not None
+
+
+def create_indexes(connection, table):
+    """Создаёт индексы модели, которых ещё нет (в том числе для таблиц, созданных до их появления в модели)."""
+    for index in Base.metadata.tables[table].indexes:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def create_partitioned_table(connection, table):
+    """
+    Создаёт секционированную таблицу с теми же колонками и индексами, что и модель.
+    В Postgres ключ секционирования обязан входить в первичный ключ, поэтому он (id, timestamp).
+    """
+    model_table = Base.metadata.tables[table]
+    columns = []
+    for column in model_table.columns:
+        if column.name == "id":
+            columns.append("id SERIAL")
+        elif column.name == "timestamp":
+            columns.append('"timestamp" TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE \'utc\')')
+        else:
+            column_type = column.type.compile(dialect=connection.dialect)
+            columns.append(f"{column.name} {column_type}{'' if column.nullable else ' NOT NULL'}")
+    columns.append('PRIMARY KEY (id, "timestamp")')
+    connection.execute(text(
+        f"CREATE TABLE {table} ({', '.join(columns)}) PARTITION BY RANGE (\"timestamp\")"
+    ))
+    # Секция по умолчанию принимает строки, для которых ещё не создана помесячная секция
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+    # Индексы на секционированной таблице автоматически создаются во всех секциях
+    create_indexes(connection, table)
+
+
+def convert_to_partitioned(connection, table):
+    """
+    Переводит существующую обычную таблицу на секционирование:
+    старая таблица переименовывается в <table>_legacy, данные переносятся в новые помесячные секции.
+    <table>_legacy не удаляется: её удаляет оператор после проверки переноса (строки без timestamp не переносятся).
+    """
+    legacy = f"{table}_legacy"
+    connection.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    # Имена индексов уникальны в схеме, освобождаем их для новой таблицы
+    index_names = [f"{table}_pkey"] + [index.name for index in Base.metadata.tables[table].indexes]
+    for name in index_names:
+        connection.execute(text(f"ALTER INDEX IF EXISTS {name} RENAME TO {name}_legacy"))
+    create_partitioned_table(connection, table)
+
+    bounds = connection.execute(text(f'SELECT min("timestamp"), max("timestamp") FROM {legacy}')).one()
+    if bounds[0] is not None:
+        month = add_months(bounds[0].date(), 0)
+        while month <= bounds[1].date():
+            create_partition(connection, table, month)
+            month = add_months(month, 1)
+
+    columns = ", ".join(f'"{column.name}"' for column in Base.metadata.tables[table].columns)
+    connection.execute(text(
+        f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy} WHERE \"timestamp\" IS NOT NULL"
+    ))
+    connection.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT max(id) FROM {legacy}), 0) + 1, false)"
+    ))
+
+
+def create_partition(connection, table, month):
+    name = partition_name(table, month)
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    ))
+    return name
+
+
+def list_partitions(connection, table):
+    """Помесячные секции таблицы: список (имя, первое число месяца)."""
+    names = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :table"
+    ), {"table": table}).scalars()
+    partitions = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match and match["table"] == table:
+            partitions.append((name, date(int(match["year"]), int(match["month"]), 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def maintain_partitions(today=None, ahead=LOG_PARTITIONS_AHEAD, retention=LOG_RETENTION_MONTHS):
+    """
+    Создаёт секции с текущего месяца на ahead месяцев вперёд и удаляет секции старше retention месяцев.
+    Возвращает списки созданных и удалённых секций.
+    """
+    this_month = add_months(today or date.today(), 0)
+    created, dropped = [], []
+    with engine.begin() as connection:
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(connection, table):
+                continue
+            existing = {name for name, _ in list_partitions(connection, table)}
+            for offset in range(ahead + 1):
+                name = create_partition(connection, table, add_months(this_month, offset))
+                if name not in existing:
+                    created.append(name)
+            if retention > 0:
+                oldest_kept = add_months(this_month, -retention)
+                for name, month in list_partitions(connection, table):
+                    if month < oldest_kept:
+                        connection.execute(text(f"DROP TABLE {name}"))
+                        dropped.append(name)
+    return created, dropped
+
+
+def migrate(partitioned=LOG_PARTITIONING):
+    """
+    Приводит схему логов к актуальной: создаёт таблицы и недостающие индексы,
+    дополняет статистику call_stats по логам, которые она не учитывает,
+    а при partitioned=True переводит таблицы на помесячное секционирование и создаёт секции.
+    Возвращает число логов, по которым пересчитана статистика (None — пересчёт не понадобился).
+    """
+    if partitioned and engine.dialect.name != "postgresql":
+        raise RuntimeError("Partitioning is supported only for PostgreSQL!")
+
+    with engine.begin() as connection:
+        existing_tables = set(inspect(connection).get_table_names())
+        for table in PARTITIONED_TABLES:
+            if not partitioned:
+                Base.metadata.tables[table].create(connection, checkfirst=True)
+            elif table not in existing_tables:
+                create_partitioned_table(connection, table)
+            elif not is_partitioned(connection, table):
+                convert_to_partitioned(connection, table)
+            create_indexes(connection, table)
+        Base.metadata.create_all(connection, tables=[
+            model_table for name, model_table in Base.metadata.tables.items() if name not in PARTITIONED_TABLES
+        ])
+        # Статистика по логам, записанным до появления call_stats. Проверяется по числу звонков, а не по тому,
+        # существовала ли таблица: её мог создать пустой старт сервиса до миграции
+        backfilled = backfill(connection)
+
+    if partitioned:
+        maintain_partitions()
+    return backfilled
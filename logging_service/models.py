@@ -1,20 +1,30 @@
 
 from datetime import datetime,timezone
-from sqlalchemy import create_engine, Column, Integer, String,DateTime
+from sqlalchemy import create_engine, BigInteger, Column, Integer, String,DateTime,Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 import dotenv
 dotenv.load_dotenv()
 import os
 
-engine = create_engine(os.getenv("SQLALCHEMY_DATABASE_URI"))
+# Пул соединений: размер, переполнение, проверка соединения перед выдачей и пересоздание старых соединений
+engine = create_engine(
+    os.getenv("SQLALCHEMY_DATABASE_URI"),
+    # Поток воркера держит одно соединение, поэтому пул по умолчанию равен числу потоков gunicorn
+    pool_size=int(os.getenv("DB_POOL_SIZE", os.getenv("GUNICORN_THREADS", 4))),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 2)),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    pool_pre_ping=True,
+)
 
 # Создаем базовый класс для моделей
 Base = declarative_base()
 
-# Настраиваем сессию для взаимодействия с базой данных
+# Настраиваем сессию для взаимодействия с базой данных.
+# scoped_session выдаёт каждому потоку (запросу) свою сессию; в конце запроса её закрывает session.remove()
 Session = sessionmaker(bind=engine)
-session = Session()
+session = scoped_session(Session)
 
 # Функция для получения текущего времени в UTC с учетом временной зоны
 def current_utc_time():
@@ -28,6 +38,12 @@ class UserLog(Base):
     action = Column(String(200), nullable=False)
     timestamp = Column(DateTime, default=current_utc_time)
 
+    # Индексы под выборки за период (keyset-пагинация по timestamp, id) и по пользователю
+    __table_args__ = (
+        Index('ix_user_logs_timestamp_id', 'timestamp', 'id'),
+        Index('ix_user_logs_username_timestamp', 'username', 'timestamp'),
+    )
+
     def __repr__(self):
         return f'<UserLog(username={self.username}, action={self.action}, timestamp={self.timestamp})>'
 
@@ -40,8 +56,48 @@ class CallLog(Base):
     status = Column(String(50), nullable=False)  # Статус звонка
     timestamp = Column(DateTime, default=current_utc_time)
 
+    __table_args__ = (
+        Index('ix_call_logs_timestamp_id', 'timestamp', 'id'),
+        Index('ix_call_logs_username_timestamp', 'username', 'timestamp'),
+    )
+
     def __repr__(self):
         return f'<CallLog(username={self.username}, call_duration={self.call_duration}, status={self.status}, timestamp={self.timestamp})>'
 
+# Границы корзин гистограммы длительностей звонков (в секундах, включительно) для оценки перцентилей.
+# Последняя корзина — звонки длиннее последней границы.
+DURATION_BUCKETS = (10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Предагрегированная статистика звонков (rollup): одна строка на интервал, пользователя и статус.
+# Обновляется в той же транзакции, что и запись логов, поэтому всегда согласована с call_logs.
+class CallStat(Base):
+    __tablename__ = 'call_stats'
+    granularity = Column(String(6), primary_key=True)  # minute, hour или day
+    bucket = Column(DateTime, primary_key=True)  # Начало интервала (UTC)
+    username = Column(String(80), primary_key=True)
+    status = Column(String(50), primary_key=True)
+    call_count = Column(Integer, nullable=False)
+    duration_total = Column(BigInteger, nullable=False)
+    duration_min = Column(Integer, nullable=False)
+    duration_max = Column(Integer, nullable=False)
+    # Число звонков по корзинам DURATION_BUCKETS: duration_le_10 — не длиннее 10 секунд и т.д.
+    duration_le_10 = Column(Integer, nullable=False, default=0)
+    duration_le_30 = Column(Integer, nullable=False, default=0)
+    duration_le_60 = Column(Integer, nullable=False, default=0)
+    duration_le_120 = Column(Integer, nullable=False, default=0)
+    duration_le_300 = Column(Integer, nullable=False, default=0)
+    duration_le_600 = Column(Integer, nullable=False, default=0)
+    duration_le_1800 = Column(Integer, nullable=False, default=0)
+    duration_le_3600 = Column(Integer, nullable=False, default=0)
+    duration_gt_3600 = Column(Integer, nullable=False, default=0)
+
+    # Первичный ключ обслуживает выборки по интервалам, этот индекс — выборки по одному пользователю
+    __table_args__ = (
+        Index('ix_call_stats_username_bucket', 'granularity', 'username', 'bucket'),
+    )
+
+    def __repr__(self):
+        return f'<CallStat(granularity={self.granularity}, bucket={self.bucket}, username={self.username}, status={self.status}, call_count={self.call_count})>'
+
 def start_db():
     Base.metadata.create_all(engine)  
\ No newline at end of file
@@ -0,0 +1,287 @@
+from datetime import timedelta, timezone
+import os
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import DURATION_BUCKETS, CallLog, CallStat
+
+# Предагрегированная статистика звонков.
+# При каждой записи логов звонков (/log/call и /log/call/batch) в той же транзакции обновляются строки
+# call_stats за минуту, час и сутки: число звонков, суммарная, минимальная и максимальная длительность
+# и гистограмма длительностей по статусу. Отчёты читают эти строки вместо сырых логов, поэтому объём
+# выборки зависит от числа интервалов и пользователей, а не от числа звонков.
+#
+# flask migrate дополняет статистику по логам, записанным до её появления (см. backfill),
+# flask stats-rebuild пересчитывает статистику по call_logs,
+# flask stats-prune удаляет поминутную статистику старше CALL_STATS_MINUTE_RETENTION_DAYS.
+
+GRANULARITIES = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
+# Сколько дней хранить поминутную статистику (0 — хранить всё); часовая и суточная хранятся всегда
+CALL_STATS_MINUTE_RETENTION_DAYS = int(os.getenv("CALL_STATS_MINUTE_RETENTION_DAYS", 7))
+# Максимальное число интервалов в одном запросе статистики
+CALL_STATS_MAX_BUCKETS = int(os.getenv("CALL_STATS_MAX_BUCKETS", 10000))
+# Сколько строк статистики обновлять одним запросом
+CALL_STATS_UPSERT_CHUNK = int(os.getenv("CALL_STATS_UPSERT_CHUNK", 1000))
+
+PERCENTILES = (50, 90, 95, 99)
+HISTOGRAM_COLUMNS = [f"duration_le_{bound}" for bound in DURATION_BUCKETS] + [f"duration_gt_{DURATION_BUCKETS[-1]}"]
+KEY_COLUMNS = ("granularity", "bucket", "username", "status")
+
+
+def naive_utc(timestamp):
+    """Время в UTC без часового пояса, как оно хранится в call_logs."""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def bucket_start(timestamp, granularity):
+    """Начало интервала granularity, в который попадает timestamp."""
+    if granularity == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def histogram_column(duration):
+    for bound, column in zip(DURATION_BUCKETS, HISTOGRAM_COLUMNS):
+        if duration <= bound:
+            return column
+    return HISTOGRAM_COLUMNS[-1]
+
+
+def aggregate(logs):
+    """
+    Складывает логи звонков (username, call_duration, status, timestamp) в строки call_stats.
+    Возвращает словарь {(granularity, bucket, username, status): строка}.
+    """
+    rows = {}
+    for username, duration, status, timestamp in logs:
+        # Значения одиночной записи не проверяются заранее, приводим их так же, как это сделала база
+        duration = int(duration)
+        if isinstance(status, bool):
+            status = "true" if status else "false"
+        timestamp = naive_utc(timestamp)
+        column = histogram_column(duration)
+        for granularity in GRANULARITIES:
+            key = (granularity, bucket_start(timestamp, granularity), username, str(status))
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = {
+                    **dict(zip(KEY_COLUMNS, key)),
+                    "call_count": 0,
+                    "duration_total": 0,
+                    "duration_min": duration,
+                    "duration_max": duration,
+                    **dict.fromkeys(HISTOGRAM_COLUMNS, 0),
+                }
+            row["call_count"] += 1
+            row["duration_total"] += duration
+            row["duration_min"] = min(row["duration_min"], duration)
+            row["duration_max"] = max(row["duration_max"], duration)
+            row[column] += 1
+    return rows
+
+
+def stats_upsert(dialect_name, rows):
+    """Запрос, прибавляющий строки к call_stats (новые строки вставляются)."""
+    insert = postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+    # В SQLite min() и max() с двумя аргументами работают как LEAST и GREATEST
+    least, greatest = (func.least, func.greatest) if dialect_name == "postgresql" else (func.min, func.max)
+    statement = insert(CallStat).values(rows)
+    excluded = statement.excluded
+    set_ = {
+        "call_count": CallStat.call_count + excluded.call_count,
+        "duration_total": CallStat.duration_total + excluded.duration_total,
+        "duration_min": least(CallStat.duration_min, excluded.duration_min),
+        "duration_max": greatest(CallStat.duration_max, excluded.duration_max),
+    }
+    for column in HISTOGRAM_COLUMNS:
+        set_[column] = getattr(CallStat, column) + getattr(excluded, column)
+    return statement.on_conflict_do_update(index_elements=list(KEY_COLUMNS), set_=set_)
+
+
+def write_stats(connection, dialect_name, rows):
+    """
+    Записывает агрегаты в call_stats порциями по CALL_STATS_UPSERT_CHUNK строк.
+    Строки идут в порядке ключа, поэтому параллельные транзакции блокируют общие строки
+    в одном порядке и не попадают во взаимоблокировку.
+    """
+    ordered = [rows[key] for key in sorted(rows)]
+    for offset in range(0, len(ordered), CALL_STATS_UPSERT_CHUNK):
+        connection.execute(stats_upsert(dialect_name, ordered[offset:offset + CALL_STATS_UPSERT_CHUNK]))
+
+
+def record_call_stats(session, logs):
+    """Обновляет статистику по только что записанным логам звонков в транзакции сессии."""
+    rows = aggregate(logs)
+    if rows:
+        write_stats(session, session.get_bind().dialect.name, rows)
+
+
+def rebuild(connection, since=None):
+    """
+    Пересчитывает статистику по call_logs начиная с суток, в которые попадает since (по умолчанию — всю).
+    Логи читаются по порядку времени, агрегаты записываются по завершении каждых суток,
+    поэтому память не зависит от объёма логов. Возвращает число обработанных логов.
+    """
+    cleanup = delete(CallStat)
+    query = select(CallLog.username, CallLog.call_duration, CallLog.status, CallLog.timestamp).where(
+        CallLog.timestamp.is_not(None)
+    )
+    if since is not None:
+        since = bucket_start(naive_utc(since), "day")
+        cleanup = cleanup.where(CallStat.bucket >= since)
+        query = query.where(CallLog.timestamp >= since)
+    connection.execute(cleanup)
+
+    processed, day, logs = 0, None, []
+    for log in connection.execute(query.order_by(CallLog.timestamp).execution_options(yield_per=1000)):
+        log_day = naive_utc(log.timestamp).date()
+        if log_day != day and logs:
+            write_stats(connection, connection.dialect.name, aggregate(logs))
+            logs = []
+        day = log_day
+        logs.append(tuple(log))
+        processed += 1
+    if logs:
+        write_stats(connection, connection.dialect.name, aggregate(logs))
+    return processed
+
+
+def backfill(connection):
+    """
+    Пересчитывает статистику, если она учитывает не все логи звонков. Так бывает, когда call_stats создана пустой
+    при старте сервиса (create_all) раньше flask migrate и звонки, записанные до обновления, в неё не попали.
+    Пересчёт начинается с первых суток, за которые остались логи, поэтому статистика за уже удалённые
+    секции логов сохраняется. Возвращает число пересчитанных логов или None, если статистика полна.
+    """
+    first, logged = connection.execute(
+        select(func.min(CallLog.timestamp), func.count()).select_from(CallLog).where(CallLog.timestamp.is_not(None))
+    ).one()
+    if not logged:
+        return None
+    since = bucket_start(naive_utc(first), "day")
+    counted = connection.execute(
+        select(func.coalesce(func.sum(CallStat.call_count), 0)).where(
+            CallStat.granularity == "day", CallStat.bucket >= since
+        )
+    ).scalar()
+    if counted >= logged:
+        return None
+    return rebuild(connection, since)
+
+
+def prune(connection, now, retention_days=CALL_STATS_MINUTE_RETENTION_DAYS):
+    """Удаляет поминутную статистику старше retention_days суток. Возвращает число удалённых строк."""
+    if retention_days <= 0:
+        return 0
+    oldest_kept = bucket_start(naive_utc(now), "day") - timedelta(days=retention_days)
+    result = connection.execute(
+        delete(CallStat).where(CallStat.granularity == "minute", CallStat.bucket < oldest_kept)
+    )
+    return result.rowcount
+
+
+def grouped(session, conditions, *keys):
+    """Суммирует строки call_stats по keys и статусу. Возвращает {значения keys: агрегат}."""
+    columns = [
+        func.sum(CallStat.call_count),
+        func.sum(CallStat.duration_total),
+        func.min(CallStat.duration_min),
+        func.max(CallStat.duration_max),
+        *(func.sum(getattr(CallStat, column)) for column in HISTOGRAM_COLUMNS),
+    ]
+    query = select(*keys, CallStat.status, *columns).where(*conditions).group_by(*keys, CallStat.status)
+    groups = {}
+    for row in session.execute(query):
+        key = tuple(row[:len(keys)])
+        status, count, total, minimum, maximum, *histogram = row[len(keys):]
+        group = groups.setdefault(key, new_aggregate())
+        merge(group, {
+            "count": int(count),
+            "total": int(total),
+            "min": minimum,
+            "max": maximum,
+            "histogram": [int(value) for value in histogram],
+            "statuses": {status: int(count)},
+        })
+    return groups
+
+
+def new_aggregate():
+    return {"count": 0, "total": 0, "min": None, "max": None, "histogram": [0] * len(HISTOGRAM_COLUMNS), "statuses": {}}
+
+
+def merge(target, source):
+    target["count"] += source["count"]
+    target["total"] += source["total"]
+    if source["min"] is not None:
+        target["min"] = source["min"] if target["min"] is None else min(target["min"], source["min"])
+        target["max"] = source["max"] if target["max"] is None else max(target["max"], source["max"])
+    target["histogram"] = [a + b for a, b in zip(target["histogram"], source["histogram"])]
+    for status, count in source["statuses"].items():
+        target["statuses"][status] = target["statuses"].get(status, 0) + count
+
+
+def percentile(aggregate, q):
+    """
+    Оценка перцентиля длительности по гистограмме: линейная интерполяция внутри корзины,
+    границы корзины сужаются до фактических минимума и максимума.
+    """
+    rank = aggregate["count"] * q / 100
+    cumulative, lower = 0, 0
+    for index, count in enumerate(aggregate["histogram"]):
+        upper = DURATION_BUCKETS[index] if index < len(DURATION_BUCKETS) else aggregate["max"]
+        if count and cumulative + count >= rank:
+            low, high = max(lower, aggregate["min"]), min(upper, aggregate["max"])
+            return round(low + (high - low) * (rank - cumulative) / count, 1)
+        cumulative += count
+        lower = upper
+    return aggregate["max"]
+
+
+def summarize(aggregate):
+    count = aggregate["count"]
+    return {
+        "count": count,
+        "total_duration": aggregate["total"],
+        "avg_duration": round(aggregate["total"] / count, 1) if count else None,
+        "min_duration": aggregate["min"],
+        "max_duration": aggregate["max"],
+        "percentiles": {f"p{q}": percentile(aggregate, q) if count else None for q in PERCENTILES},
+        "statuses": aggregate["statuses"],
+    }
+
+
+def call_stats(session, granularity, start_date, end_date, username=None, group_by=("interval", "user"), users_limit=None):
+    """
+    Статистика звонков за период по интервалам granularity и по пользователям.
+    Период расширяется до границ интервалов, в которые попадают start_date и end_date.
+    """
+    conditions = [
+        CallStat.granularity == granularity,
+        CallStat.bucket >= bucket_start(start_date, granularity),
+        CallStat.bucket <= end_date,
+    ]
+    if username is not None:
+        conditions.append(CallStat.username == username)
+
+    result = {}
+    total = new_aggregate()
+    if "interval" in group_by:
+        intervals = grouped(session, conditions, CallStat.bucket)
+        result["intervals"] = [
+            {"start": bucket.strftime("%Y-%m-%dT%H:%M:%S"), **summarize(aggregate)}
+            for (bucket,), aggregate in sorted(intervals.items())
+        ]
+    if "user" in group_by:
+        users = grouped(session, conditions, CallStat.username)
+        ranked = sorted(users.items(), key=lambda item: (-item[1]["count"], item[0]))
+        result["users"] = [{"username": name, **summarize(aggregate)} for (name,), aggregate in ranked[:users_limit]]
+    groups = intervals if "interval" in group_by else users if "user" in group_by else grouped(session, conditions)
+    for aggregate in groups.values():
+        merge(total, aggregate)
+    return {"total": summarize(total), **result}
@@ -0,0 +1,16 @@
+#!/bin/sh
+# Схема приводится к актуальной до запуска сервиса: flask migrate добавляет колонку phone_normalized
+# в существующую таблицу users, без неё запросы к пользователям завершаются ошибкой
+# (DB_MIGRATE_ON_STARTUP=false — миграции запускаются отдельно)
+if [ "${DB_MIGRATE_ON_STARTUP:-true}" = "true" ]; then
+    flask --app main migrate || exit 1
+fi
+# Режим запуска задаётся SERVER_MODE:
+# production (по умолчанию) — gunicorn с несколькими воркерами, development — встроенный сервер Flask
+if [ "${SERVER_MODE:-production}" = "development" ]; then
+    exec flask run --host=0.0.0.0 --port=8001
+fi
+# Воркеры gunicorn пишут метрики Prometheus в общий каталог, GET /metrics отдаёт их сумму (см. metrics.py)
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+exec gunicorn --config gunicorn.conf.py main:app
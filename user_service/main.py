@@ -1,4 +1,8 @@
 from flask import Flask, jsonify, request
+from sqlalchemy import or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+import json
 import os
 import dotenv
 
@@ -8,27 +12,176 @@ app = Flask(__name__)
 
 
 # Импортируем модели, чтобы они регистрировались в SQLAlchemy
-from models import User,start_db,session
+from models import User,Session,engine,start_db,session
+from migrations import migrate
+from phones import PHONE_INDEX, PhoneIndex, normalize_phone, normalize_prefix
+import metrics
 
-# Создаем таблицы, если их нет
-@app.before_request
-def create_tables():
+# Время запросов по маршрутам и к базе, X-Request-ID и GET /metrics (см. metrics.py)
+metrics.init_app(app)
+metrics.instrument_engine(engine)
+
+# Схема создаётся один раз при старте сервиса, а не перед каждым запросом.
+# При DB_CREATE_ON_STARTUP=false схемой управляет только команда `flask migrate`.
+DB_CREATE_ON_STARTUP = os.getenv("DB_CREATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+if DB_CREATE_ON_STARTUP:
     start_db()
 
 
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Закрываем сессию запроса и возвращаем соединение в пул."""
+    session.remove()
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Создаёт таблицы, колонку и индекс нормализованных номеров; заполняет номера у существующих пользователей."""
+    normalized, skipped = migrate()
+    print(f"Migration completed. Normalized phones: {normalized}, skipped: {skipped}.")
+
+
+# Номера пользователей в памяти процесса для поиска по номеру и по префиксу
+phone_index = PhoneIndex(Session, User)
+
+
 @app.get("/")
 def home():
     return "Welcome by user_service!"
 
-# GET /users — Получение списка всех пользователей
+
+# Размер страницы списка пользователей по умолчанию и максимальный
+USERS_PAGE_DEFAULT_LIMIT = int(os.getenv("USERS_PAGE_DEFAULT_LIMIT", 100))
+USERS_PAGE_MAX_LIMIT = int(os.getenv("USERS_PAGE_MAX_LIMIT", 1000))
+# Максимальное количество ID и телефонов в одном запросе пакетного поиска
+USERS_LOOKUP_MAX_ITEMS = int(os.getenv("USERS_LOOKUP_MAX_ITEMS", 1000))
+# Максимальное количество пользователей в одном запросе пакетного создания
+USERS_BULK_MAX_ITEMS = int(os.getenv("USERS_BULK_MAX_ITEMS", 10000))
+# Сколько пользователей вставлять одним многострочным INSERT
+USERS_BULK_CHUNK = int(os.getenv("USERS_BULK_CHUNK", 1000))
+# Размер выдачи поиска по префиксу номера по умолчанию
+USERS_SEARCH_DEFAULT_LIMIT = int(os.getenv("USERS_SEARCH_DEFAULT_LIMIT", 20))
+
+
+def serialize_user(user):
+    return {"id": user.id, "name": user.username, "phone": user.phone}
+
+
+def list_arg(name):
+    """Значения параметра, переданные через запятую и/или повтором параметра."""
+    return [value for raw in request.args.getlist(name) for value in raw.split(',') if value]
+
+
+# GET /users — Получение списка пользователей
 @app.get("/users/")
 def users():
     """
-    Извлекает список всех пользователей из базы данных.
+    Извлекает список пользователей из базы данных, упорядоченный по id, постранично.
     Возвращает список пользователей с их id, именем и телефоном.
+    Необязательные параметры:
+    - 'username' и 'phone' оставляют только пользователя с таким именем или телефоном;
+    - 'ids' и 'phones' (через запятую или повтором параметра) — пакетный поиск:
+      пользователи, у которых id или телефон из списка (ненайденные просто отсутствуют в ответе).
+      Телефоны сравниваются после приведения к E.164, поэтому номер находится в любой записи;
+    - 'limit' — размер страницы, 'cursor' — значение заголовка X-Next-Cursor из предыдущей страницы.
+    """
+    query = session.query(User)  # Используем session.query для получения пользователей
+    if request.args.get('username'):
+        query = query.filter(User.username == request.args['username'])
+    if request.args.get('phone'):
+        phone = normalize_phone(request.args['phone'])
+        if phone is None:
+            return jsonify({"message": "Invalid phone number!"}), 400
+        query = query.filter(User.phone_normalized == phone)
+
+    ids, phones = list_arg('ids'), list_arg('phones')
+    if len(ids) + len(phones) > USERS_LOOKUP_MAX_ITEMS:
+        return jsonify({"message": f"Too many ids and phones! Maximum is {USERS_LOOKUP_MAX_ITEMS}."}), 400
+    if ids or phones:
+        try:
+            ids = [int(user_id) for user_id in ids]
+        except ValueError:
+            return jsonify({"message": "Ids must be integers!"}), 400
+        phones = [normalize_phone(phone) for phone in phones]
+        if None in phones:
+            return jsonify({"message": "Invalid phone number!"}), 400
+        conditions = []
+        if ids:
+            conditions.append(User.id.in_(ids))
+        if phones:
+            conditions.append(User.phone_normalized.in_(phones))
+        query = query.filter(or_(*conditions))
+
+    # Некорректный limit — ошибка, а не страница размера по умолчанию
+    try:
+        limit = int(request.args.get('limit', USERS_PAGE_DEFAULT_LIMIT))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= USERS_PAGE_MAX_LIMIT:
+        return jsonify({"message": f"Limit must be between 1 and {USERS_PAGE_MAX_LIMIT}!"}), 400
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            query = query.filter(User.id > int(cursor))
+        except ValueError:
+            return jsonify({"message": "Invalid cursor!"}), 400
+
+    # Keyset-пагинация по id; берём на одну запись больше, чтобы понять, есть ли следующая страница
+    page = query.order_by(User.id).limit(limit + 1).all()
+    headers = {}
+    if len(page) > limit:
+        page = page[:limit]
+        headers["X-Next-Cursor"] = str(page[-1].id)
+    return jsonify([serialize_user(user) for user in page]), 200, headers
+
+
+@app.get("/users/by-phone/<number>")
+def get_user_by_phone(number):
+    """
+    Извлекает пользователя по номеру телефона в любой записи (номер приводится к E.164).
+    Отвечает из индекса номеров в памяти процесса; если номера там нет, ищет в базе по индексу phone_normalized.
+    Если номер некорректен, возвращает 400, если пользователь не найден — 404.
     """
-    all_users = session.query(User).all()  # Используем session.query для получения всех пользователей
-    return jsonify([{"id": user.id, "name": user.username, "phone": user.phone} for user in all_users])
+    phone = normalize_phone(number)
+    if phone is None:
+        return jsonify({"message": "Invalid phone number!"}), 400
+    user = phone_index.lookup(phone)
+    if user is None:
+        # Пользователь мог появиться после последнего обновления индекса
+        found = session.scalars(select(User).where(User.phone_normalized == phone)).first()
+        user = serialize_user(found) if found else None
+    if user:
+        return jsonify(user)
+    return jsonify({"message": "User not found"}), 404
+
+
+@app.get("/users/search")
+def search_users():
+    """
+    Ищет пользователей, чей номер (E.164) начинается с 'prefix', по возрастанию номера.
+    Необязательный параметр 'limit' — размер выдачи (по умолчанию USERS_SEARCH_DEFAULT_LIMIT).
+    """
+    prefix = normalize_prefix(request.args.get('prefix'))
+    if prefix is None:
+        return jsonify({"message": "Prefix must be the beginning of a phone number!"}), 400
+    try:
+        limit = int(request.args.get('limit', USERS_SEARCH_DEFAULT_LIMIT))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= USERS_PAGE_MAX_LIMIT:
+        return jsonify({"message": f"Limit must be between 1 and {USERS_PAGE_MAX_LIMIT}!"}), 400
+
+    if PHONE_INDEX:
+        return jsonify(phone_index.search(prefix, limit))
+    # Префикс состоит только из '+' и цифр, экранировать в LIKE нечего
+    query = select(User).where(User.phone_normalized.like(prefix + "%")).order_by(User.phone_normalized)
+    return jsonify([serialize_user(user) for user in session.scalars(query.limit(limit))])
+
+
+@app.get("/users/phone-index")
+def phone_index_stats():
+    """Состояние индекса номеров в памяти этого процесса."""
+    return jsonify(phone_index.snapshot())
 
 
 @app.get("/users/<int:user_id>")
@@ -58,12 +211,146 @@ def create_user():
     data = request.json  # Получаем данные из тела запроса
     if not data or 'name' not in data or 'phone' not in data:
         return jsonify({"message": "Name and phone are required!"}), 400
+    phone_normalized = normalize_phone(data['phone'])
+    if phone_normalized is None:
+        return jsonify({"message": "Invalid phone number!"}), 400
 
-    new_user = User(username=data['name'], phone=data['phone'])  # Создаем нового пользователя
+    # Создаем нового пользователя
+    new_user = User(username=data['name'], phone=data['phone'], phone_normalized=phone_normalized)
     session.add(new_user)
-    session.commit()  # Сохраняем нового пользователя в базе
+    try:
+        session.commit()  # Сохраняем нового пользователя в базе
+    except IntegrityError:
+        # Имя, телефон и нормализованный телефон уникальны
+        session.rollback()
+        return jsonify({"message": "User with this name or phone already exists!"}), 409
+    phone_index.add(new_user.id, new_user.username, new_user.phone, phone_normalized)
     return jsonify({"id": new_user.id, "name": new_user.username, "phone": new_user.phone}), 201
 
+
+def read_batch():
+    """
+    Читает тело пакетного запроса: JSON-массив или NDJSON (по одному объекту в строке,
+    Content-Type: application/x-ndjson).
+    Возвращает список элементов; строки NDJSON, которые не удалось разобрать, попадают в список как None.
+    """
+    if request.mimetype in ("application/x-ndjson", "application/jsonlines"):
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+    data = request.get_json(silent=True)
+    return data if isinstance(data, list) else None
+
+
+def validate_user(item):
+    """Проверяет элемент пакета пользователей. Возвращает (строка для вставки, ошибка)."""
+    if not isinstance(item, dict):
+        return None, "Item must be a JSON object!"
+    name, phone = item.get('name'), item.get('phone')
+    if not isinstance(name, str) or not name or len(name) > 80:
+        return None, "Name is required (string up to 80 characters)!"
+    if not isinstance(phone, str) or not phone or len(phone) > 80:
+        return None, "Phone is required (string up to 80 characters)!"
+    phone_normalized = normalize_phone(phone)
+    if phone_normalized is None:
+        return None, "Invalid phone number!"
+    return {"username": name, "phone": phone, "phone_normalized": phone_normalized}, None
+
+
+def insert_users(rows):
+    """
+    Вставляет пачку строк одним INSERT ... ON CONFLICT DO NOTHING RETURNING.
+    Возвращает вставленных пользователей по имени; строки, которых нет в результате, конфликтуют с существующими.
+    """
+    insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+    statement = insert(User).values(rows).on_conflict_do_nothing().returning(
+        User.id, User.username, User.phone, User.phone_normalized
+    )
+    return {user.username: user for user in session.execute(statement)}
+
+
+# POST /users/bulk — Пакетное создание пользователей
+@app.post("/users/bulk")
+def create_users_bulk():
+    """
+    Создаёт пачку пользователей многострочными INSERT порциями по USERS_BULK_CHUNK в одной транзакции.
+    Ожидает JSON-массив или NDJSON, каждый элемент — как для POST /users/.
+    Пользователи, чьё имя или телефон уже заняты, не создаются и перечисляются в ошибках
+    с полем 'conflict' ('name' или 'phone') и id существующего пользователя.
+    """
+    items = read_batch()
+    if items is None:
+        return jsonify({"message": "Expected a JSON array or NDJSON body!"}), 400
+    if len(items) > USERS_BULK_MAX_ITEMS:
+        return jsonify({"message": f"Batch is too large! Maximum is {USERS_BULK_MAX_ITEMS} items."}), 413
+
+    rows, errors = [], []
+    seen_names, seen_phones = set(), set()
+    for index, item in enumerate(items):
+        row, error = validate_user(item)
+        if not error and row["username"] in seen_names:
+            error = "Duplicate name in batch!"
+        if not error and row["phone_normalized"] in seen_phones:
+            error = "Duplicate phone in batch!"
+        if error:
+            errors.append({"index": index, "message": error})
+            continue
+        seen_names.add(row["username"])
+        seen_phones.add(row["phone_normalized"])
+        rows.append((index, row))
+
+    created = []
+    try:
+        for offset in range(0, len(rows), USERS_BULK_CHUNK):
+            chunk = rows[offset:offset + USERS_BULK_CHUNK]
+            inserted = insert_users([row for _, row in chunk])
+            conflicts = [(index, row) for index, row in chunk if row["username"] not in inserted]
+            created.extend((index, inserted[row["username"]]) for index, row in chunk if row["username"] in inserted)
+            if conflicts:
+                errors.extend(conflict_errors(conflicts))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    for _, user in created:
+        phone_index.add(user.id, user.username, user.phone, user.phone_normalized)
+
+    errors.sort(key=lambda error: error["index"])
+    return jsonify({
+        "inserted": len(created),
+        "users": [{"index": index, "user": serialize_user(user)} for index, user in created],
+        "errors": errors,
+    }), 201 if rows or not items else 400
+
+
+def conflict_errors(conflicts):
+    """Ошибки для строк, не вставленных из-за уже существующих имени или телефона (один запрос на порцию)."""
+    names = [row["username"] for _, row in conflicts]
+    phones = [row["phone"] for _, row in conflicts]
+    normalized = [row["phone_normalized"] for _, row in conflicts]
+    existing = session.execute(
+        select(User.id, User.username, User.phone, User.phone_normalized).where(or_(
+            User.username.in_(names), User.phone.in_(phones), User.phone_normalized.in_(normalized)
+        ))
+    ).all()
+    by_name = {user.username: user.id for user in existing}
+    by_phone = {user.phone: user.id for user in existing}
+    by_phone.update({user.phone_normalized: user.id for user in existing if user.phone_normalized})
+    errors = []
+    for index, row in conflicts:
+        if row["username"] in by_name:
+            errors.append({"index": index, "message": "Name already exists!", "conflict": "name", "id": by_name[row["username"]]})
+        else:
+            user_id = by_phone.get(row["phone"], by_phone.get(row["phone_normalized"]))
+            errors.append({"index": index, "message": "Phone already exists!", "conflict": "phone", "id": user_id})
+    return errors
+
 # DELETE /users — Удаление пользователя по ID
 @app.delete("/users/<int:user_id>")
 def remove_user(user_id):
@@ -74,8 +361,10 @@ def remove_user(user_id):
     """
     user = session.get(User, user_id)  # Находим пользователя по ID
     if user:
+        phone_normalized = user.phone_normalized
         session.delete(user)
         session.commit()  # Удаляем пользователя из базы данных
+        phone_index.remove(phone_normalized)
         return jsonify({"message": "User deleted successfully."}), 200
     else:
         return jsonify({"message": "User not found!"}), 404
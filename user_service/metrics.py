@@ -0,0 +1,91 @@
+import os
+import time
+import uuid
+
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Gauge, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+
+# Метрики сервиса в формате Prometheus (GET /metrics).
+# Под gunicorn каждый воркер пишет метрики в файлы каталога PROMETHEUS_MULTIPROC_DIR (его задаёт entrypoint.sh),
+# а /metrics складывает их по всем воркерам. Идентификатор запроса X-Request-ID принимается от шлюза
+# (или создаётся) и возвращается в ответе, gunicorn пишет его в журнал вместе со временем ответа.
+
+REQUEST_ID_HEADER = "X-Request-ID"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Время обработки запроса до начала ответа",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds",
+    "Время выполнения запроса к базе",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "db_pool_connections",
+    "Соединения пула SQLAlchemy: выданные (checked_out) и свободные (idle)",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+
+
+def registry():
+    """Реестр для ответа /metrics: под gunicorn — сумма по файлам всех воркеров."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        collector_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collector_registry)
+        return collector_registry
+    return REGISTRY
+
+
+def init_app(app):
+    """Измерение времени запросов по маршрутам, X-Request-ID и маршрут GET /metrics."""
+
+    @app.before_request
+    def start_request():
+        g.request_started = time.perf_counter()
+        g.request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            # Шаблон маршрута, а не путь: /users/<int:user_id>, чтобы число рядов метрики не росло с числом ID
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            REQUEST_LATENCY.labels(request.method, route, str(response.status_code)).observe(time.perf_counter() - started)
+        response.headers[REQUEST_ID_HEADER] = g.get("request_id", "")
+        return response
+
+    @app.get("/metrics")
+    def metrics():
+        return Response(generate_latest(registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def instrument_engine(engine):
+    """Время запросов к базе по виду (SELECT, INSERT, ...) и заполненность пула соединений движка."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(connection, cursor, statement, parameters, context, executemany):
+        context.query_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def observe_query(connection, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "query_started", None)
+        if started is not None:
+            operation = statement.split(None, 1)[0].upper() if statement.strip() else "OTHER"
+            DB_QUERY_LATENCY.labels(operation).observe(time.perf_counter() - started)
+
+    def update_pool(returning):
+        # Пул берётся у движка при каждом событии: после engine.dispose() в воркере он новый.
+        # Событие checkin приходит до того, как пул принял соединение обратно, поэтому учитываем его сами
+        pool = engine.pool
+        DB_POOL_CONNECTIONS.labels("checked_out").set(pool.checkedout() - returning)
+        DB_POOL_CONNECTIONS.labels("idle").set(pool.checkedin() + returning)
+
+    event.listen(engine, "checkout", lambda *args: update_pool(0))
+    event.listen(engine, "checkin", lambda *args: update_pool(1))
@@ -0,0 +1,54 @@
+from sqlalchemy import bindparam, inspect, select, text, update
+from sqlalchemy.schema import CreateIndex
+
+from models import Base, User, engine
+from phones import normalize_phone
+
+# Управление схемой пользователей.
+# Запуск: flask --app main migrate — создаёт таблицы, добавляет колонку phone_normalized в существующую
+# таблицу users, заполняет её по колонке phone и создаёт недостающие индексы.
+
+# Сколько строк обновлять одним запросом при заполнении phone_normalized
+BACKFILL_CHUNK = 1000
+
+
+def backfill_phones(connection):
+    """
+    Заполняет phone_normalized у пользователей, у которых он пуст.
+    Номер, который нельзя привести к E.164 или который после приведения совпал с номером другого
+    пользователя, остаётся пустым. Возвращает (число заполненных, число пропущенных).
+    """
+    taken = set(connection.execute(
+        select(User.phone_normalized).where(User.phone_normalized.is_not(None))
+    ).scalars())
+    rows = connection.execute(
+        select(User.id, User.phone).where(User.phone_normalized.is_(None)).order_by(User.id)
+    ).all()
+    updates, skipped = [], 0
+    for row in rows:
+        normalized = normalize_phone(row.phone)
+        if normalized is None or normalized in taken:
+            skipped += 1
+            continue
+        taken.add(normalized)
+        updates.append({"user_id": row.id, "normalized": normalized})
+
+    statement = update(User.__table__).where(User.id == bindparam("user_id")).values(
+        phone_normalized=bindparam("normalized")
+    )
+    for offset in range(0, len(updates), BACKFILL_CHUNK):
+        connection.execute(statement, updates[offset:offset + BACKFILL_CHUNK])
+    return len(updates), skipped
+
+
+def migrate():
+    """Приводит схему пользователей к актуальной. Возвращает результат backfill_phones."""
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+        columns = {column["name"] for column in inspect(connection).get_columns("users")}
+        if "phone_normalized" not in columns:
+            connection.execute(text("ALTER TABLE users ADD COLUMN phone_normalized VARCHAR(16)"))
+        result = backfill_phones(connection)
+        for index in User.__table__.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
+    return result
@@ -1,18 +1,28 @@
-from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy import create_engine, Column, Index, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 import dotenv
 dotenv.load_dotenv()
 import os
 
-engine = create_engine(os.getenv("SQLALCHEMY_DATABASE_URI"))
+# Пул соединений: размер, переполнение, проверка соединения перед выдачей и пересоздание старых соединений
+engine = create_engine(
+    os.getenv("SQLALCHEMY_DATABASE_URI"),
+    # Поток воркера держит одно соединение, поэтому пул по умолчанию равен числу потоков gunicorn
+    pool_size=int(os.getenv("DB_POOL_SIZE", os.getenv("GUNICORN_THREADS", 4))),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 2)),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    pool_pre_ping=True,
+)
 
 # Создаем базовый класс для моделей
 Base = declarative_base()
 
-# Настраиваем сессию для взаимодействия с базой данных
+# Настраиваем сессию для взаимодействия с базой данных.
+# scoped_session выдаёт каждому потоку (запросу) свою сессию; в конце запроса её закрывает session.remove()
 Session = sessionmaker(bind=engine)
-session = Session()
+session = scoped_session(Session)
 
 
 
@@ -21,7 +31,14 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     username = Column(String(80), unique=True, nullable=False)
     phone = Column(String(80), unique=True, nullable=False)
-
+    # Номер в формате E.164 (см. phones.py); пусто у старых записей, номер которых не удалось привести
+    phone_normalized = Column(String(16))
+
+    # Уникальный индекс для поиска по номеру; в Postgres с varchar_pattern_ops, чтобы им пользовался и LIKE 'префикс%'
+    __table_args__ = (
+        Index('ix_users_phone_normalized', 'phone_normalized', unique=True,
+              postgresql_ops={'phone_normalized': 'varchar_pattern_ops'}),
+    )
     
     def __repr__(self):
         return f'<User(username={self.username}, phone={self.phone})>'
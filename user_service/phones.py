@@ -0,0 +1,175 @@
+from bisect import bisect_left, insort
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import select
+
+# Номера телефонов в формате E.164 и индекс номеров в памяти процесса.
+# При записи пользователя номер приводится к E.164 (+<код страны><номер>, до 15 цифр) и хранится
+# в индексированной колонке phone_normalized рядом с исходной строкой phone.
+# Для определения абонента по входящему звонку номера держатся в памяти воркера: словарь для точного поиска
+# и отсортированный массив для поиска по префиксу (bisect). Новые пользователи подгружаются по id раз в
+# PHONE_INDEX_REFRESH_INTERVAL секунд, полная перезагрузка (учёт удалений в других воркерах) — раз в
+# PHONE_INDEX_RELOAD_INTERVAL секунд. Изменения, сделанные этим воркером, применяются к индексу сразу.
+
+# Код страны для номеров без '+' и без международного префикса '00' (пусто — номер уже содержит код страны)
+PHONE_DEFAULT_COUNTRY_CODE = os.getenv("PHONE_DEFAULT_COUNTRY_CODE", "")
+# Национальный префикс, который отбрасывается перед добавлением кода страны (например, 8 или 0)
+PHONE_TRUNK_PREFIX = os.getenv("PHONE_TRUNK_PREFIX", "")
+# Держать номера в памяти процесса (false — все поиски идут в базу по индексу)
+PHONE_INDEX = os.getenv("PHONE_INDEX", "true").lower() in ("1", "true", "yes")
+PHONE_INDEX_REFRESH_INTERVAL = float(os.getenv("PHONE_INDEX_REFRESH_INTERVAL", 1))
+PHONE_INDEX_RELOAD_INTERVAL = float(os.getenv("PHONE_INDEX_RELOAD_INTERVAL", 30))
+
+SEPARATORS = re.compile(r"[\s().\-/]")
+E164 = re.compile(r"^\+[1-9]\d{1,14}$")
+PREFIX = re.compile(r"^\+\d{0,15}$")
+
+
+def to_international(number):
+    """Убирает разделители и приводит номер к виду +<цифры> (без проверки длины)."""
+    number = SEPARATORS.sub("", number)
+    if number.startswith("00"):
+        return "+" + number[2:]
+    if number.startswith("+") or not PHONE_DEFAULT_COUNTRY_CODE:
+        return number if number.startswith("+") else "+" + number
+    if PHONE_TRUNK_PREFIX and number.startswith(PHONE_TRUNK_PREFIX):
+        number = number[len(PHONE_TRUNK_PREFIX):]
+    return f"+{PHONE_DEFAULT_COUNTRY_CODE}{number}"
+
+
+def normalize_phone(number):
+    """Номер в формате E.164 или None, если строку нельзя считать номером телефона."""
+    if not isinstance(number, str):
+        return None
+    number = to_international(number)
+    return number if E164.match(number) else None
+
+
+def normalize_prefix(prefix):
+    """Начало номера, приведённое так же, как номер целиком, или None."""
+    if not isinstance(prefix, str) or not prefix.strip():
+        return None
+    prefix = to_international(prefix)
+    return prefix if PREFIX.match(prefix) else None
+
+
+class PhoneIndex:
+    """Номера E.164 пользователей в памяти процесса: точный поиск и поиск по префиксу."""
+
+    def __init__(self, session_factory, model):
+        self.session_factory = session_factory
+        self.model = model
+        self.lock = threading.Lock()
+        # Обновление индекса выполняет один поток, остальные тем временем читают прежнюю версию
+        self.refresh_lock = threading.Lock()
+        # Номер -> (id, имя, исходный номер) и отсортированный список номеров для поиска по префиксу
+        self.by_phone = {}
+        self.phones = []
+        self.max_id = 0
+        # PID процесса, в котором загружен индекс: после fork воркера gunicorn его нужно загрузить заново
+        self.pid = None
+        self.refreshed = 0.0
+        self.reloaded = 0.0
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "reloads": 0}
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, "size": len(self.phones), "max_id": self.max_id, "loaded": self.pid == os.getpid()}
+
+    def lookup(self, phone):
+        """Пользователь {'id', 'name', 'phone'} с номером phone (E.164) или None, если в индексе его нет."""
+        self._ensure_fresh()
+        with self.lock:
+            entry = self.by_phone.get(phone)
+            self.stats["hits" if entry else "misses"] += 1
+        return self._user(phone, entry) if entry else None
+
+    def search(self, prefix, limit):
+        """До limit пользователей, чей номер начинается с prefix, по возрастанию номера."""
+        self._ensure_fresh()
+        with self.lock:
+            start = bisect_left(self.phones, prefix)
+            found = []
+            for phone in self.phones[start:start + limit]:
+                if not phone.startswith(prefix):
+                    break
+                found.append(self._user(phone, self.by_phone[phone]))
+        return found
+
+    def add(self, user_id, username, phone, normalized):
+        """Добавляет пользователя, созданного этим процессом."""
+        if not normalized or self.pid != os.getpid():
+            return
+        with self.lock:
+            self._add(user_id, username, phone, normalized)
+
+    def remove(self, normalized):
+        """Удаляет номер пользователя, удалённого этим процессом."""
+        if not normalized or self.pid != os.getpid():
+            return
+        with self.lock:
+            if self.by_phone.pop(normalized, None) is not None:
+                index = bisect_left(self.phones, normalized)
+                if index < len(self.phones) and self.phones[index] == normalized:
+                    del self.phones[index]
+
+    @staticmethod
+    def _user(phone, entry):
+        user_id, username, raw_phone = entry
+        return {"id": user_id, "name": username, "phone": raw_phone}
+
+    def _add(self, user_id, username, phone, normalized):
+        if normalized not in self.by_phone:
+            insort(self.phones, normalized)
+        self.by_phone[normalized] = (user_id, username, phone)
+        self.max_id = max(self.max_id, user_id)
+
+    def _rows(self, after_id=0):
+        model = self.model
+        query = select(model.id, model.username, model.phone, model.phone_normalized).where(
+            model.phone_normalized.is_not(None), model.id > after_id
+        )
+        session = self.session_factory()
+        try:
+            return session.execute(query.order_by(model.id)).all()
+        finally:
+            session.close()
+
+    def _ensure_fresh(self):
+        if not PHONE_INDEX:
+            return
+        now = time.monotonic()
+        loaded = self.pid == os.getpid()
+        if loaded and now - self.refreshed < PHONE_INDEX_REFRESH_INTERVAL:
+            return
+        # Пока индекс не загружен, ждём загрузки; загруженный индекс обновляется без ожидания
+        if not self.refresh_lock.acquire(blocking=not loaded):
+            return
+        try:
+            self._refresh(now)
+        finally:
+            self.refresh_lock.release()
+
+    def _refresh(self, now):
+        if self.pid == os.getpid() and now - self.refreshed < PHONE_INDEX_REFRESH_INTERVAL:
+            return
+        if self.pid != os.getpid() or now - self.reloaded >= PHONE_INDEX_RELOAD_INTERVAL:
+            rows = self._rows()
+            by_phone = {row.phone_normalized: (row.id, row.username, row.phone) for row in rows}
+            with self.lock:
+                self.by_phone = by_phone
+                self.phones = sorted(by_phone)
+                self.max_id = max((row.id for row in rows), default=0)
+                self.pid = os.getpid()
+                self.refreshed = self.reloaded = now
+                self.stats["reloads"] += 1
+            return
+        rows = self._rows(self.max_id)
+        with self.lock:
+            for row in rows:
+                self._add(row.id, row.username, row.phone, row.phone_normalized)
+            self.refreshed = now
+            self.stats["refreshes"] += 1